@@ -0,0 +1,329 @@
+"""用户批量导入、数据流式导出"""
+
+import csv
+import io
+import json
+import zlib
+from collections import defaultdict
+from typing import AsyncIterator
+
+from casbin_tortoise_adapter import CasbinRule
+from fastapi import HTTPException
+from pydantic import ValidationError
+from starlette.responses import StreamingResponse
+from tortoise.transactions import in_transaction
+
+from apps.system import schemas
+from apps.system.models import Role, User
+from apps.system.utils import set_relations
+from core.security import async_get_password_hash, async_get_password_hashes
+from core.pagination import keyset_batches
+from core.settings import EXPORT_BATCH_SIZE, USER_IMPORT_BATCH_SIZE
+
+
+def _decode(line: bytes) -> str | None:
+    try:
+        return line.decode("utf-8-sig").strip()
+    except UnicodeDecodeError:
+        return None
+
+
+async def iter_lines(
+    stream: AsyncIterator[bytes],
+) -> AsyncIterator[tuple[int, str | None]]:
+    """
+    按行读取请求体，跳过空行
+    :param stream: 请求体
+    :return: (行号, 内容)，不是 UTF-8 编码的行内容为 None
+    """
+    buffer, line_no = b"", 0
+    async for chunk in stream:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            line_no += 1
+            if (text := _decode(line)) != "":
+                yield line_no, text
+    if (text := _decode(buffer)) != "":
+        yield line_no + 1, text
+
+
+async def iter_rows(
+    stream: AsyncIterator[bytes], fmt: schemas.DataFormat
+) -> AsyncIterator[tuple[int, dict | str]]:
+    """
+    解析 CSV（首行为表头，每行一条记录）或 NDJSON
+    :return: (行号, 数据)，无法解析的行返回错误信息
+    """
+    header = None
+    async for line_no, text in iter_lines(stream):
+        if text is None:
+            yield line_no, "编码错误，请使用 UTF-8 编码"
+        elif fmt == schemas.DataFormat.NDJSON:
+            try:
+                data = json.loads(text)
+            except ValueError:
+                data = None
+            yield line_no, data if isinstance(data, dict) else "格式错误"
+        elif header is None:
+            header = [name.strip() for name in next(csv.reader([text]))]
+        else:
+            values = next(csv.reader([text]))
+            # CSV 中的空值视为未填写
+            yield line_no, {k: v for k, v in zip(header, values) if v != ""}
+
+
+class UserImporter:
+    """
+    批量导入用户：按 USER_IMPORT_BATCH_SIZE 分批校验，在进程池中并行计算密码哈希，
+    每批在一个事务中 bulk_create 用户并批量写入用户角色；
+    出错的行记录到结果中，不影响其他行，哈希计算繁忙或写入失败时只影响当前批次
+    """
+
+    def __init__(self, batch_size: int = USER_IMPORT_BATCH_SIZE):
+        self.batch_size = batch_size
+        self.result = schemas.UserImportResult(created=0, failed=0)
+        self._roles: dict[str, int] = {}
+        self._usernames: set[str] = set()
+        self._default_hash: str | None = None
+
+    async def run(
+        self, stream: AsyncIterator[bytes], fmt: schemas.DataFormat
+    ) -> schemas.UserImportResult:
+        self._roles = {
+            name: pk for name, pk in await Role.all().values_list("name", "id")
+        }
+        batch: list[tuple[int, schemas.UserImportRow]] = []
+        async for line_no, data in iter_rows(stream, fmt):
+            if (row := self._validate(line_no, data)) is None:
+                continue
+            batch.append((line_no, row))
+            if len(batch) >= self.batch_size:
+                await self._import(batch)
+                batch = []
+        if batch:
+            await self._import(batch)
+        return self.result
+
+    def _error(self, line_no: int, username: str | None, message: str):
+        self.result.failed += 1
+        self.result.errors.append(
+            schemas.UserImportError(line=line_no, username=username, message=message)
+        )
+
+    def _validate(self, line_no: int, data: dict | str) -> schemas.UserImportRow | None:
+        if isinstance(data, str):
+            self._error(line_no, None, data)
+            return None
+        try:
+            row = schemas.UserImportRow.model_validate(data)
+        except ValidationError as e:
+            error = e.errors()[0]
+            field = ".".join(str(loc) for loc in error["loc"])
+            self._error(line_no, data.get("username"), f"{field}: {error['msg']}")
+            return None
+        if row.active_role and row.active_role not in row.roles:
+            row.roles.append(row.active_role)
+        if missing := [name for name in row.roles if name not in self._roles]:
+            self._error(line_no, row.username, f"角色不存在: {', '.join(missing)}")
+            return None
+        if row.username in self._usernames:
+            self._error(line_no, row.username, "用户名重复")
+            return None
+        self._usernames.add(row.username)
+        return row
+
+    async def _import(self, batch: list[tuple[int, schemas.UserImportRow]]):
+        existing = set(
+            await User.filter(
+                username__in=[row.username for _, row in batch]
+            ).values_list("username", flat=True)
+        )
+        rows = []
+        for line_no, row in batch:
+            if row.username in existing:
+                self._error(line_no, row.username, "用户名已存在")
+            else:
+                rows.append((line_no, row))
+        if not rows:
+            return
+
+        try:
+            # 未填写密码的用户共用一个默认密码哈希
+            if any(row.password is None for _, row in rows) and not self._default_hash:
+                self._default_hash = await async_get_password_hash("123456")
+            hashes = iter(
+                await async_get_password_hashes(
+                    [row.password for _, row in rows if row.password is not None]
+                )
+            )
+        except HTTPException as e:
+            # 哈希进程池繁忙（503），已提交的批次结果保留
+            for line_no, row in rows:
+                self._error(line_no, row.username, f"写入失败: {e.detail}")
+            return
+        users = [
+            User(
+                username=row.username,
+                password=self._default_hash if row.password is None else next(hashes),
+                is_staff=row.is_staff,
+                is_superuser=row.is_superuser,
+                active_role_id=self._roles.get(row.active_role or ""),
+                **({"avatar": row.avatar} if row.avatar else {}),
+            )
+            for _, row in rows
+        ]
+        try:
+            async with in_transaction():
+                await User.bulk_create(users, batch_size=self.batch_size)
+                ids = {
+                    username: pk
+                    for username, pk in await User.filter(
+                        username__in=[row.username for _, row in rows]
+                    ).values_list("username", "id")
+                }
+                await set_relations(
+                    User,
+                    "roles",
+                    {
+                        ids[row.username]: [self._roles[name] for name in row.roles]
+                        for _, row in rows
+                        if row.roles
+                    },
+                )
+        except Exception as e:
+            for line_no, row in rows:
+                self._error(line_no, row.username, f"写入失败: {e}")
+            return
+        self.result.created += len(rows)
+
+
+# 导出的字段，用户不导出密码；roles、active_role 为角色名，与导入格式一致
+USER_EXPORT_FIELDS = [
+    "id",
+    "username",
+    "is_staff",
+    "is_superuser",
+    "avatar",
+    "last_login",
+    "roles",
+    "active_role",
+]
+ROLE_EXPORT_FIELDS = ["id", "name", "remark"]
+POLICY_EXPORT_FIELDS = ["id", "ptype", "v0", "v1", "v2"]
+
+
+async def iter_users(batch_size: int = EXPORT_BATCH_SIZE) -> AsyncIterator[list[dict]]:
+    """按批遍历用户，每批额外一次查询补充角色名"""
+    async for rows in keyset_batches(
+        User.all(),
+        batch_size,
+        *USER_EXPORT_FIELDS[:-2],
+        active_role="active_role__name",
+    ):
+        roles = defaultdict(list)
+        for user_id, name in (
+            await Role.filter(users__id__in=[row["id"] for row in rows])
+            .order_by("id")
+            .values_list("users__id", "name")
+        ):
+            roles[user_id].append(name)
+        for row in rows:
+            row["roles"] = roles[row["id"]]
+        yield rows
+
+
+async def iter_roles(batch_size: int = EXPORT_BATCH_SIZE) -> AsyncIterator[list[dict]]:
+    async for rows in keyset_batches(Role.all(), batch_size, *ROLE_EXPORT_FIELDS):
+        yield rows
+
+
+async def iter_policies(
+    batch_size: int = EXPORT_BATCH_SIZE,
+) -> AsyncIterator[list[dict]]:
+    async for rows in keyset_batches(
+        CasbinRule.all(), batch_size, *POLICY_EXPORT_FIELDS
+    ):
+        yield rows
+
+
+def encode_rows(rows: list[dict], fields: list[str], fmt: schemas.DataFormat) -> str:
+    """
+    编码一批数据，CSV 中的列表使用 ; 拼接
+    :param rows: 数据
+    :param fields: 导出的字段
+    :param fmt: 数据格式
+    """
+    if fmt == schemas.DataFormat.NDJSON:
+        return "".join(
+            json.dumps(
+                {field: row[field] for field in fields},
+                ensure_ascii=False,
+                default=str,
+            )
+            + "\n"
+            for row in rows
+        )
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerows(
+        [
+            ";".join(value) if isinstance(value, list) else value
+            for value in (row[field] for field in fields)
+        ]
+        for row in rows
+    )
+    return buffer.getvalue()
+
+
+async def iter_export(
+    batches: AsyncIterator[list[dict]],
+    fields: list[str],
+    fmt: schemas.DataFormat,
+    compress: bool = False,
+) -> AsyncIterator[bytes]:
+    """
+    逐批编码（可选 gzip 压缩）后输出，内存中只保留一批数据
+    :param batches: 分批数据
+    :param fields: 导出的字段
+    :param fmt: 数据格式
+    :param compress: 是否 gzip 压缩
+    """
+    compressor = zlib.compressobj(wbits=31) if compress else None
+
+    def encode(text: str) -> bytes:
+        data = text.encode()
+        return compressor.compress(data) if compressor else data
+
+    if fmt == schemas.DataFormat.CSV:
+        yield encode(",".join(fields) + "\n")
+    async for rows in batches:
+        if data := encode(encode_rows(rows, fields, fmt)):
+            yield data
+    if compressor:
+        yield compressor.flush()
+
+
+def export_response(
+    name: str,
+    batches: AsyncIterator[list[dict]],
+    fields: list[str],
+    fmt: schemas.DataFormat,
+    compress: bool = False,
+) -> StreamingResponse:
+    """
+    流式导出为附件下载
+    :param name: 文件名（不含扩展名）
+    """
+    filename = f"{name}.{fmt}"
+    if compress:
+        media_type, filename = "application/gzip", f"{filename}.gz"
+    elif fmt == schemas.DataFormat.NDJSON:
+        media_type = "application/x-ndjson"
+    else:
+        media_type = "text/csv; charset=utf-8"
+    return StreamingResponse(
+        iter_export(batches, fields, fmt, compress),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
@@ -1,49 +1,224 @@
 """依赖项、后台权限系统"""
 
+import asyncio
+import logging
 import os.path
+from dataclasses import dataclass
+from datetime import timedelta
+from typing import Iterable
 
-import casbin_tortoise_adapter
-from casbin import AsyncEnforcer
 from fastapi import Depends, HTTPException
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
-from jose import JWTError, jwt
+from jose import JWTError
 from starlette.requests import Request
+from starlette.routing import BaseRoute
 
-from apps.system.models import User
-from core.settings import ALGORITHM, SECRET_KEY
+from apps.system.enforcer import Enforcer, TortoiseAdapter
+from apps.system.models import ChangeLog, User
+from apps.system.schemas import Token, to_policy_path
+from apps.system.watcher import ORIGIN, ChangeLogReader, PolicyWatcher
+from core.cache import TTLCache
+from core.security import decode_token, generate_token
+from core.settings import (
+    AUTH_STATELESS,
+    POLICY_SYNC_INTERVAL,
+    PRINCIPAL_CACHE_SIZE,
+    PRINCIPAL_CACHE_TTL,
+    REFRESH_TOKEN_EXPIRE_MINUTES,
+    STATELESS_ACCESS_TOKEN_EXPIRE_MINUTES,
+)
 
+logger = logging.getLogger(__name__)
 
-async def init_casbin() -> AsyncEnforcer:
-    adapter = casbin_tortoise_adapter.TortoiseAdapter()
+
+@dataclass(frozen=True, slots=True)
+class Principal:
+    """已认证用户的身份信息，只包含鉴权需要的字段"""
+
+    id: int
+    username: str
+    is_superuser: bool
+    is_staff: bool
+    active_role_id: int | None
+
+    @classmethod
+    def from_user(cls, user: User) -> "Principal":
+        return cls(
+            id=user.id,
+            username=user.username,
+            is_superuser=user.is_superuser,
+            is_staff=user.is_staff,
+            active_role_id=user.active_role_id,  # type: ignore[attr-defined]
+        )
+
+
+# 用户名 -> Principal，用户信息、角色变更时需通过 principal_invalidations 失效
+principal_cache: TTLCache[str, Principal] = TTLCache(
+    PRINCIPAL_CACHE_SIZE, PRINCIPAL_CACHE_TTL
+)
+
+
+class PrincipalInvalidations:
+    """
+    用户身份缓存同步：principal_cache 保存在各进程内存中，失效时写入一条 ChangeLog，
+    其他进程轮询后清除本地缓存
+    """
+
+    topic = "principal"
+
+    def __init__(self, interval: float = POLICY_SYNC_INTERVAL):
+        self.interval = interval
+        self.log = ChangeLogReader(self.topic)
+
+    async def invalidate(self, *usernames: str):
+        """
+        清除指定用户的身份缓存并通知其他进程，与变更处于同一事务时其他进程在提交后才会看到
+        :param usernames: 用户名
+        """
+        if not usernames:
+            return
+        payload = {"usernames": list(usernames)}
+        self._apply(payload)
+        await ChangeLog.create(
+            topic=self.topic, op="invalidate", payload=payload, origin=ORIGIN
+        )
+
+    async def clear(self):
+        """清空全部身份缓存并通知其他进程"""
+        self._apply(None)
+        await ChangeLog.create(topic=self.topic, op="clear", origin=ORIGIN)
+
+    @staticmethod
+    def _apply(payload: dict | None):
+        if payload is None:
+            principal_cache.clear()
+            return
+        for username in payload["usernames"]:
+            principal_cache.pop(username)
+
+    async def start(self):
+        """记录当前版本号，启动前的变更不影响空的本地缓存"""
+        await self.log.start()
+
+    async def run(self):
+        """后台轮询其他进程的失效记录"""
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                for row in await self.log.read():
+                    self._apply(row.payload if row.op == "invalidate" else None)
+            except Exception:
+                logger.exception("同步用户身份缓存失败")
+
+
+principal_invalidations = PrincipalInvalidations()
+
+
+async def init_casbin(routes: Iterable[BaseRoute] = ()) -> Enforcer:
+    """
+    初始化权限执行器
+    :param routes: 应用路由表，用于编译角色权限位图
+    """
+    adapter = TortoiseAdapter()
     model_file = os.path.join(os.path.dirname(__file__), "model.conf")
 
-    e = AsyncEnforcer(model_file, adapter)
+    e = Enforcer(model_file, adapter)
+    e.set_routes(routes)
+    e.set_watcher(PolicyWatcher(e))
+    await e.watcher.start()
     await e.load_policy()
     return e
 
 
+async def get_principal(username: str) -> Principal | None:
+    """
+    获取用户身份信息，优先读取缓存
+    :param username: 用户名
+    :return:
+    """
+    if principal := principal_cache.get(username):
+        return principal
+    row = (
+        await User.filter(username=username)
+        .first()
+        .values("id", "username", "is_superuser", "is_staff", "active_role_id")
+    )
+    if row is None:
+        return None
+    principal = Principal(**row)
+    principal_cache.set(username, principal)
+    return principal
+
+
+def route_template(request: Request) -> str:
+    """当前请求匹配到的路由模板（策略路径格式），未匹配时返回请求路径"""
+    if route := request.scope.get("route"):
+        return to_policy_path(route.path)
+    return request.url.path
+
+
+def create_token(principal: Principal, token_version: int = 0) -> Token:
+    """
+    签发token，无状态认证模式下 access token 携带身份信息并同时签发刷新token
+    :param principal: 用户身份
+    :param token_version: 用户当前 token 版本
+    """
+    if not AUTH_STATELESS:
+        return Token(token=generate_token(principal.username), refresh_token=None)
+    claims = {
+        "uid": principal.id,
+        "su": principal.is_superuser,
+        "staff": principal.is_staff,
+        "role": principal.active_role_id,
+    }
+    return Token(
+        token=generate_token(
+            principal.username,
+            timedelta(minutes=STATELESS_ACCESS_TOKEN_EXPIRE_MINUTES),
+            claims,
+        ),
+        refresh_token=generate_token(
+            principal.username,
+            timedelta(minutes=REFRESH_TOKEN_EXPIRE_MINUTES),
+            {"typ": "refresh", "ver": token_version},
+        ),
+    )
+
+
 async def jwt_auth(security: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
     """检查用户token"""
     token = security.credentials
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        user = await User.get(username=username)
-        return user
+        payload = decode_token(token)
     except JWTError:
         raise HTTPException(401, "用户认证失败")
+    username = payload.get("sub")
+    if not isinstance(username, str) or payload.get("typ") == "refresh":
+        raise HTTPException(401, "用户认证失败")
+    if AUTH_STATELESS and "uid" in payload:
+        return Principal(
+            id=payload["uid"],
+            username=username,
+            is_superuser=payload["su"],
+            is_staff=payload["staff"],
+            active_role_id=payload["role"],
+        )
+    if principal := await get_principal(username):
+        return principal
+    raise HTTPException(401, "用户认证失败")
 
 
-async def check_permission(request: Request, user: User = Depends(jwt_auth)):
+async def check_permission(request: Request, user: Principal = Depends(jwt_auth)):
     """检查用户是否有权限访问"""
     if user.is_superuser:
         return user
     if not user.is_staff:
         raise HTTPException(401, "账号无法登录后台")
-    role = await user.active_role.first() if user.active_role else None
-    if role is None:
+    if user.active_role_id is None:
         raise HTTPException(401, "用户未激活角色")
     enforcer = request.app.state.enforcer
-    if enforcer.enforce(str(role.id), request.url.path, request.method):
+    if enforcer.enforce(
+        str(user.active_role_id), route_template(request), request.method
+    ):
         return user
     raise HTTPException(403, "没有访问权限")
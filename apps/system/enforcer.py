@@ -0,0 +1,365 @@
+"""Casbin 权限执行器"""
+
+import functools
+from collections import defaultdict
+from typing import Callable, Iterable
+
+import casbin_tortoise_adapter
+from casbin import AsyncEnforcer
+from casbin.util import key_match2
+
+from apps.system.schemas import to_policy_path
+from core.cache import LRUCache
+from core.settings import DECISION_CACHE_SIZE, ENFORCER_MODE
+
+
+class TortoiseAdapter(casbin_tortoise_adapter.TortoiseAdapter):
+    """
+    Tortoise 适配器，bulk_create 不返回结果时原实现的 add_policies 会报错；
+    原实现的 remove_policies 把所有规则拼成一个 OR 条件，规则多时嵌套过深，改为分批删除
+    """
+
+    remove_batch_size = 200
+
+    async def add_policies(self, sec: str, ptype: str, rules: list) -> bool:
+        await self.modelclass.bulk_create(
+            [self._to_rule(ptype, rule) for rule in rules]
+        )
+        return True
+
+    async def remove_policies(self, sec: str, ptype: str, rules: list) -> bool:
+        removed = False
+        for i in range(0, len(rules), self.remove_batch_size):
+            batch = rules[i : i + self.remove_batch_size]
+            removed = await super().remove_policies(sec, ptype, batch) or removed
+        return removed
+
+
+class PolicyIndex:
+    """
+    编译后的策略索引：角色 -> 路由模板 -> 请求方法集合
+
+    与 model.conf 的匹配规则保持一致：路由模板完全相同时直接命中哈希索引，
+    包含 :id、* 的策略再按 keyMatch2 兜底匹配（只遍历该角色自己的策略），
+    请求方法支持 * 通配。
+
+    设置路由表后，每个 (路由模板, 请求方法) 对应一个固定的位序号，
+    角色的权限编译为一个整数位图，判定只需一次位运算，多角色判定为位图按位或
+    """
+
+    def __init__(self):
+        self._rules: defaultdict[str, dict[str, set[str]]] = defaultdict(dict)
+        self._patterns: defaultdict[str, dict[str, set[str]]] = defaultdict(dict)
+        self._bits: dict[str, dict[str, int]] = {}
+        self._masks: dict[str, int] = {}
+
+    def set_routes(self, routes: Iterable[tuple[str, str]]) -> None:
+        """
+        设置路由表，按顺序为每个 (路由模板, 请求方法) 分配位序号
+        :param routes: (策略路径格式的路由模板, 请求方法) 列表
+        """
+        self._bits.clear()
+        for bit, (path, method) in enumerate(dict.fromkeys(routes)):
+            self._bits.setdefault(path, {})[method] = bit
+        self._masks.clear()
+
+    def add(self, rule: list[str]) -> None:
+        sub, obj, act = rule[:3]
+        self._rules[sub].setdefault(obj, set()).add(act)
+        if ":" in obj or "*" in obj:
+            self._patterns[sub].setdefault(obj, set()).add(act)
+        self._masks.pop(sub, None)
+
+    def remove(self, rule: list[str]) -> None:
+        sub, obj, act = rule[:3]
+        for index in (self._rules, self._patterns):
+            if (acts := index.get(sub, {}).get(obj)) is None:
+                continue
+            acts.discard(act)
+            if not acts:
+                del index[sub][obj]
+            if not index[sub]:
+                del index[sub]
+        self._masks.pop(sub, None)
+
+    def rebuild(self, rules: Iterable[list[str]]) -> None:
+        self._rules.clear()
+        self._patterns.clear()
+        self._masks.clear()
+        for rule in rules:
+            self.add(rule)
+
+    def mask(self, sub: str) -> int:
+        """角色的权限位图，策略变更后按需重新编译"""
+        mask = self._masks.get(sub)
+        if mask is None:
+            mask = self._masks[sub] = self._compile(sub)
+        return mask
+
+    def _compile(self, sub: str) -> int:
+        mask = 0
+        patterns = self._patterns.get(sub, {})
+        for obj, acts in self._rules.get(sub, {}).items():
+            if obj in patterns:
+                paths = [path for path in self._bits if key_match2(path, obj)]
+            else:
+                paths = [obj] if obj in self._bits else []
+            for path in paths:
+                for method, bit in self._bits[path].items():
+                    if method in acts or "*" in acts:
+                        mask |= 1 << bit
+        return mask
+
+    def match(self, subs: Iterable[str], obj: str, act: str) -> bool:
+        """
+        判断任一角色是否有权限
+        :param subs: 角色列表
+        :param obj: 路由模板
+        :param act: 请求方法
+        """
+        bit = self._bits.get(obj, {}).get(act)
+        if bit is not None:
+            mask = 0
+            for sub in subs:
+                mask |= self.mask(sub)
+            return mask >> bit & 1 == 1
+        return any(self._match_rules(sub, obj, act) for sub in subs)
+
+    def _match_rules(self, sub: str, obj: str, act: str) -> bool:
+        if (acts := self._rules.get(sub, {}).get(obj)) and (act in acts or "*" in acts):
+            return True
+        for pattern, acts in self._patterns.get(sub, {}).items():
+            if (act in acts or "*" in acts) and key_match2(obj, pattern):
+                return True
+        return False
+
+    def __contains__(self, route: tuple[str, str]) -> bool:
+        path, method = route
+        return method in self._bits.get(path, {})
+
+
+def _track(func: Callable, affected: Callable[..., list]):
+    """
+    包装策略变更方法：执行后按模型中的实际结果同步策略索引，并清空授权结果缓存，
+    再写入 watcher 待通知的变更
+    :param func: AsyncEnforcer 的内部变更方法
+    :param affected: 根据调用参数返回受影响的规则
+    """
+
+    @functools.wraps(func)
+    async def wrapper(self: "Enforcer", sec, ptype, *args):
+        rules = affected(self, sec, ptype, *args)
+        try:
+            result = await func(self, sec, ptype, *args)
+        finally:
+            self.sync_rules(sec, ptype, rules)
+        # casbin 只同步调用 watcher.update 时，在调用方的事务中写入变更日志
+        if flush := getattr(self.watcher, "flush", None):
+            await flush()
+        return result
+
+    return wrapper
+
+
+def _reload(func: Callable):
+    """包装策略加载方法：加载后重建策略索引，并清空授权结果缓存"""
+
+    @functools.wraps(func)
+    async def wrapper(self: "Enforcer", *args, **kwargs):
+        try:
+            return await func(self, *args, **kwargs)
+        finally:
+            self.rebuild_index()
+
+    return wrapper
+
+
+class Enforcer(AsyncEnforcer):
+    """
+    带授权结果缓存的 AsyncEnforcer
+
+    缓存键为 (角色ID, 路由模板, 请求方法)，任何策略变更（增删改、重新加载）都会清空缓存。
+    mode 为 compiled 时使用 PolicyIndex 判定（已编译路由按位图判定），否则交给 casbin 逐条匹配
+    """
+
+    def __init__(
+        self,
+        model=None,
+        adapter=None,
+        cache_size: int = DECISION_CACHE_SIZE,
+        mode: str = ENFORCER_MODE,
+    ):
+        self.mode = mode
+        self.policy_index = PolicyIndex()
+        self.decision_cache: LRUCache[tuple, bool] = LRUCache(cache_size)
+        super().__init__(model, adapter)
+
+    def set_routes(self, routes: Iterable) -> None:
+        """
+        根据应用路由表编译角色权限位图
+        :param routes: app.routes
+        """
+        self.policy_index.set_routes(
+            (to_policy_path(route.path), method)
+            for route in routes
+            for method in sorted(getattr(route, "methods", None) or ())
+        )
+        self.decision_cache.clear()
+
+    def enforce(self, *rvals) -> bool:
+        if (
+            self.mode == "compiled"
+            and len(rvals) == 3
+            and (rvals[1], rvals[2]) in self.policy_index
+        ):
+            # 已编译的路由直接位运算判定，无需经过缓存
+            return self.enforce_roles([rvals[0]], *rvals[1:])
+        decision = self.decision_cache.get(rvals)
+        if decision is None:
+            if self.mode == "compiled" and len(rvals) == 3:
+                decision = self.enforce_roles([rvals[0]], *rvals[1:])
+            else:
+                decision = super().enforce(*rvals)
+            self.decision_cache.set(rvals, decision)
+        return decision
+
+    def enforce_roles(self, roles: Iterable[str], obj: str, act: str) -> bool:
+        """
+        多角色权限判定，任一角色有权限即通过
+        :param roles: 角色ID列表
+        :param obj: 路由模板
+        :param act: 请求方法
+        """
+        if self.mode != "compiled":
+            return any(self.enforce(role, obj, act) for role in roles)
+        subs = list(roles)
+        # 存在 g 规则时一并判定继承的角色
+        for role in list(subs):
+            subs.extend(self._implicit_roles(role))
+        return self.policy_index.match(subs, obj, act)
+
+    def _implicit_roles(self, name: str) -> list[str]:
+        if not self._policy("g", "g"):
+            return []
+        roles, queue = [], [name]
+        while queue:
+            name = queue.pop(0)
+            for rm in self.rm_map.values():
+                for role in rm.get_roles(name):
+                    if role not in roles:
+                        roles.append(role)
+                        queue.append(role)
+        return roles
+
+    def _policy(self, sec: str, ptype: str) -> list[list[str]]:
+        assertion = self.model.model.get(sec, {}).get(ptype)
+        return assertion.policy if assertion else []
+
+    def sync_rules(self, sec: str, ptype: str, rules: list[list[str]]) -> None:
+        """
+        按模型中的实际状态同步指定规则的索引
+        :param sec: 策略段 p/g
+        :param ptype: 策略类型
+        :param rules: 可能发生变化的规则
+        """
+        self.decision_cache.clear()
+        if self.mode != "compiled" or sec != "p" or ptype != "p":
+            return
+        current = {tuple(rule) for rule in self._policy(sec, ptype)}
+        for rule in rules:
+            if tuple(rule) in current:
+                self.policy_index.add(rule)
+            else:
+                self.policy_index.remove(rule)
+
+    def apply_change(
+        self,
+        op: str,
+        sec: str,
+        ptype: str,
+        rules: list[list[str]] | None = None,
+        field_index: int = 0,
+        field_values: list[str] | None = None,
+    ) -> None:
+        """
+        应用其他进程的策略变更，只修改内存模型，不写入数据库
+        :param op: add/remove/remove_filtered
+        :param sec: 策略段 p/g
+        :param ptype: 策略类型
+        :param rules: add/remove 的规则
+        :param field_index: remove_filtered 的起始字段
+        :param field_values: remove_filtered 的字段值
+        """
+        changed: list[list[str]]
+        if op == "remove_filtered":
+            changed = self.model.get_filtered_policy(
+                sec, ptype, field_index, *field_values or []
+            )
+            self.model.remove_filtered_policy(
+                sec, ptype, field_index, *field_values or []
+            )
+        else:
+            changed = [list(rule) for rule in rules or []]
+            for rule in changed:
+                if op == "add":
+                    self.model.add_policy(sec, ptype, rule)
+                elif op == "remove":
+                    self.model.remove_policy(sec, ptype, rule)
+        if sec == "g":
+            self.build_role_links()
+        self.sync_rules(sec, ptype, changed)
+
+    def rebuild_index(self) -> None:
+        """根据模型中的全部策略重建索引"""
+        self.decision_cache.clear()
+        if self.mode == "compiled":
+            self.policy_index.rebuild(self._policy("p", "p"))
+
+    def clear_policy(self):
+        super().clear_policy()
+        self.rebuild_index()
+
+    load_policy = _reload(AsyncEnforcer.load_policy)
+    load_filtered_policy = _reload(AsyncEnforcer.load_filtered_policy)
+    load_increment_filtered_policy = _reload(
+        AsyncEnforcer.load_increment_filtered_policy
+    )
+    _add_policy = _track(
+        AsyncEnforcer._add_policy, lambda self, sec, ptype, rule: [rule]
+    )
+    _add_policies = _track(
+        AsyncEnforcer._add_policies, lambda self, sec, ptype, rules: list(rules)
+    )
+    _update_policy = _track(
+        AsyncEnforcer._update_policy,
+        lambda self, sec, ptype, old_rule, new_rule: [old_rule, new_rule],
+    )
+    _update_policies = _track(
+        AsyncEnforcer._update_policies,
+        lambda self, sec, ptype, old_rules, new_rules: [*old_rules, *new_rules],
+    )
+    _update_filtered_policies = _track(
+        AsyncEnforcer._update_filtered_policies,
+        lambda self, sec, ptype, new_rules, field_index, *field_values: [
+            *self.model.get_filtered_policy(sec, ptype, field_index, *field_values),
+            *new_rules,
+        ],
+    )
+    _remove_policy = _track(
+        AsyncEnforcer._remove_policy, lambda self, sec, ptype, rule: [rule]
+    )
+    _remove_policies = _track(
+        AsyncEnforcer._remove_policies, lambda self, sec, ptype, rules: list(rules)
+    )
+    _remove_filtered_policy = _track(
+        AsyncEnforcer._remove_filtered_policy,
+        lambda self, sec, ptype, field_index, *field_values: (
+            self.model.get_filtered_policy(sec, ptype, field_index, *field_values)
+        ),
+    )
+    _remove_filtered_policy_returns_effects = _track(
+        AsyncEnforcer._remove_filtered_policy_returns_effects,
+        lambda self, sec, ptype, field_index, *field_values: (
+            self.model.get_filtered_policy(sec, ptype, field_index, *field_values)
+        ),
+    )
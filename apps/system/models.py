@@ -1,5 +1,7 @@
 from enum import IntEnum
 
+from tortoise.exceptions import ValidationError
+
 from core.models import AbstractBaseModel, AbstractUser, fields
 
 from .schemas import MenuMeta
@@ -12,6 +14,9 @@ class User(AbstractUser):
     active_role: fields.ForeignKeyRelation["Role"] = fields.ForeignKeyField(
         "models.Role", related_name="active_user", null=True, description="当前角色"
     )
+    token_version = fields.IntField(
+        default=0, description="token版本，递增后已签发的刷新token失效"
+    )
 
 
 class Role(AbstractBaseModel):
@@ -35,6 +40,7 @@ class Menu(AbstractBaseModel):
     parent: fields.ForeignKeyRelation["Menu"] = fields.ForeignKeyField(
         "models.Menu", related_name="children", null=True, description="父菜单"
     )
+    parent_id: int | None
     path = fields.CharField(max_length=128, null=True, description="路由地址")
     component = fields.CharField(max_length=128, null=True, description="组件")
     meta: MenuMeta = fields.JSONField(null=True, description="菜单元数据")
@@ -44,3 +50,64 @@ class Menu(AbstractBaseModel):
     type = fields.IntEnumField(
         MenuType, default=MenuType.DIRECTORY, description="菜单类型"
     )
+    tree_path = fields.CharField(
+        max_length=255, default="/", index=True, description="祖先路径，如 /1/5/"
+    )
+    depth = fields.IntField(default=0, description="层级，根菜单为0")
+
+    @property
+    def subtree_path(self) -> str:
+        """子孙菜单的 tree_path 前缀"""
+        return f"{self.tree_path}{self.id}/"
+
+    @property
+    def ancestor_ids(self) -> list[int]:
+        """祖先菜单ID，从根菜单开始"""
+        return [int(i) for i in self.tree_path.strip("/").split("/") if i]
+
+    async def save(self, using_db=None, update_fields=None, *args, **kwargs) -> None:
+        """保存时根据父菜单维护 tree_path、depth，移动菜单时同步更新子孙菜单"""
+        if update_fields is not None and not {"parent", "parent_id"} & set(
+            update_fields
+        ):
+            return await super().save(using_db, update_fields, *args, **kwargs)
+
+        old_path = self.tree_path if self._saved_in_db else None
+        if self.parent_id is None:
+            tree_path = "/"
+        else:
+            parent = await Menu.filter(id=self.parent_id).using_db(using_db).first()
+            if parent is None:
+                raise ValidationError("父菜单不存在")
+            tree_path = parent.subtree_path
+            if self._saved_in_db and f"/{self.id}/" in tree_path:
+                raise ValidationError("不能移动到自身或子菜单下")
+        self.tree_path, self.depth = tree_path, tree_path.count("/") - 1
+        if update_fields is not None:
+            update_fields = [*update_fields, "tree_path", "depth"]
+        await super().save(using_db, update_fields, *args, **kwargs)
+
+        if old_path is not None and old_path != self.tree_path:
+            old_prefix = f"{old_path}{self.id}/"
+            descendants = await Menu.filter(tree_path__startswith=old_prefix).using_db(
+                using_db
+            )
+            for menu in descendants:
+                menu.tree_path = self.subtree_path + menu.tree_path[len(old_prefix) :]
+                menu.depth = menu.tree_path.count("/") - 1
+            if descendants:
+                await Menu.bulk_update(
+                    descendants,
+                    fields=["tree_path", "depth"],
+                    batch_size=500,
+                    using_db=using_db,
+                )
+
+
+class ChangeLog(AbstractBaseModel):
+    """变更日志，自增ID即版本号，用于多进程间同步内存状态"""
+
+    topic = fields.CharField(max_length=32, index=True, description="主题")
+    op = fields.CharField(max_length=32, description="操作")
+    payload = fields.JSONField(null=True, description="变更内容")
+    origin = fields.CharField(max_length=64, description="来源进程")
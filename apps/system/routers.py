@@ -1,18 +1,37 @@
-import os.path
-import time
-from datetime import datetime
-from typing import Annotated
+from typing import Annotated, cast
 
-
-from fastapi import APIRouter, Depends, Form, Query
+from fastapi import APIRouter, Depends, Form, HTTPException, Query, Response
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
+from jose import JWTError
 from starlette.requests import Request
-from tortoise.transactions import atomic
+from tortoise.exceptions import ValidationError
+from tortoise.expressions import F, Q
+from tortoise.transactions import atomic, in_transaction
 
 import apps.system.deps as deps
 import apps.system.models as model
 import apps.system.schemas as schema
+from apps.system.bulk import (
+    POLICY_EXPORT_FIELDS,
+    ROLE_EXPORT_FIELDS,
+    USER_EXPORT_FIELDS,
+    UserImporter,
+    export_response,
+    iter_policies,
+    iter_roles,
+    iter_users,
+)
+from apps.system.storage import UploadRoute, UploadSession, file_response, save_file
+from apps.system.utils import (
+    MenuBundle,
+    last_login_buffer,
+    list2tree,
+    menu_tree_cache,
+    token_revocations,
+)
 from core import security
-from core.settings import DISK_PATH
+from core.pagination import count_total, fetch_by_ids, keyset_paginate
+from core.settings import BATCH_MAX_IDS, DISK_REQUIRE_PERMISSION, UPLOAD_MAX_SIZE
 
 auth = APIRouter(prefix="", tags=["Auth"])
 
@@ -20,90 +39,194 @@ auth = APIRouter(prefix="", tags=["Auth"])
 @auth.get(
     "/routes", summary="获取路由列表", response_model=schema.PageResult[schema.Route]
 )
-def get_routes(request: Request):
-    data = []
-    for route in request.app.routes:
-        for method in route.methods:
-            obj = schema.Route(**route.__dict__, method=method)
-            data.append(obj)
-    return schema.PageResult.ok(data, total=len(data))
-
-
+async def get_routes(
+    request: Request,
+    tag: str | None = Query(None, description="路由分组"),
+    prefix: str | None = Query(None, description="路由地址前缀"),
+):
+    etag, body = request.app.state.route_catalog.get(tag, prefix)
+    headers = {"ETag": etag}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
 
 
-@auth.post(
-    "/upload", summary="上传文件", response_model=schema.UploadFileResult
-)
 async def upload(
     request: Request,
     payload: Annotated[
         schema.UploadFilePayload, Form(media_type="multipart/form-data")
     ],
 ):
-    if not payload.key:
-        payload.key = f"{int(time.time())}.{payload.file.filename.split('.')[1]}"
-    os.makedirs(os.path.join(DISK_PATH, *payload.key.split("/")[:-1]), exist_ok=True)
-    with open(os.path.join(DISK_PATH, payload.key), "wb") as buffer:
-        content = await payload.file.read()
-        buffer.write(content)
-    url = f"{request.base_url}/{DISK_PATH}/{payload.key}"
-    return dict(url=url, key=payload.key)
+    if payload.file.size is not None and payload.file.size > UPLOAD_MAX_SIZE:
+        raise HTTPException(413, "文件过大")
+    key, digest, size = await save_file(
+        payload.file.file, payload.key or None, payload.file.filename
+    )
+    return dict(url=file_url(request, key), key=key, sha256=digest, size=size)
+
+
+# 使用 UploadRoute 在解析表单前拒绝超限的请求体
+auth.add_api_route(
+    "/upload",
+    upload,
+    methods=["POST"],
+    summary="上传文件",
+    response_model=schema.UploadFileResult,
+    route_class_override=UploadRoute,
+)
+
+
+def file_url(request: Request, key: str) -> str:
+    return f"{request.base_url}disk/{key}"
+
+
+@auth.post(
+    "/upload/session",
+    summary="创建分片上传会话",
+    response_model=schema.UploadSessionResult,
+)
+async def create_upload_session(payload: schema.UploadSessionPayload):
+    session = UploadSession.create(payload.filename, payload.size, payload.key)
+    return dict(upload_id=session.id, offset=0, size=session.size)
+
+
+@auth.get(
+    "/upload/session/{upload_id}",
+    summary="查询分片上传进度",
+    response_model=schema.UploadSessionResult,
+)
+async def query_upload_session(upload_id: str):
+    session = UploadSession.get(upload_id)
+    return dict(upload_id=session.id, offset=session.offset, size=session.size)
+
+
+@auth.put(
+    "/upload/session/{upload_id}",
+    summary="上传分片，请求体为分片内容",
+    response_model=schema.UploadSessionResult,
+)
+async def upload_chunk(
+    request: Request,
+    upload_id: str,
+    offset: int = Query(..., ge=0, description="分片起始位置，须等于已上传的字节数"),
+):
+    session = UploadSession.get(upload_id)
+    offset = await session.append(offset, request.stream())
+    return dict(upload_id=session.id, offset=offset, size=session.size)
+
+
+@auth.post(
+    "/upload/session/{upload_id}/complete",
+    summary="完成分片上传",
+    response_model=schema.UploadFileResult,
+)
+async def complete_upload_session(request: Request, upload_id: str):
+    session = UploadSession.get(upload_id)
+    key, digest, size = await session.complete()
+    return dict(url=file_url(request, key), key=key, sha256=digest, size=size)
 
 
 @auth.post("/login", response_model=schema.Result[schema.Token])
 async def login(payload: schema.Login):
     if obj := await model.User.get_or_none(username=payload.username):
-        if security.verify_password(payload.password, obj.password):
-            token = security.generate_token(obj.username)
-            obj.last_login = datetime.now()
-            await obj.save()
-            return schema.Result.ok(schema.Token(token=token))
+        verified, new_hash = await security.async_verify_and_update_password(
+            payload.password, obj.password
+        )
+        if verified:
+            token = deps.create_token(deps.Principal.from_user(obj), obj.token_version)
+            if new_hash:
+                # bcrypt 成本因子变更后透明地重新哈希
+                obj.password = new_hash
+                await obj.save(update_fields=["password"])
+            last_login_buffer.record(obj.id)
+            return schema.Result.ok(token)
     return schema.Result.error("用户名或密码错误")
 
 
-def list2tree(
-    arr: list, parent_name: str = "parent_id", children_name: str = "children"
+@auth.post("/refresh", summary="刷新token", response_model=schema.Result[schema.Token])
+async def refresh(payload: schema.RefreshToken):
+    try:
+        claims = security.decode_token(payload.refresh_token)
+    except JWTError:
+        return schema.Result.error("刷新token无效")
+    if claims.get("typ") == "refresh":
+        obj = await model.User.get_or_none(username=claims["sub"])
+        # 重置密码、修改用户、分配角色后 token 版本递增，旧的刷新token失效；
+        # 刷新时按版本条件递增，刷新token只能使用一次，在多个进程上并发重放也只有一次成功
+        if obj and await model.User.filter(
+            id=obj.id, token_version=claims.get("ver")
+        ).update(token_version=F("token_version") + 1):
+            obj.token_version = claims["ver"] + 1
+            token = deps.create_token(deps.Principal.from_user(obj), obj.token_version)
+            return schema.Result.ok(token)
+    return schema.Result.error("刷新token无效")
+
+
+@auth.post("/logout", summary="退出登录", response_model=schema.Result)
+async def logout(
+    credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer()),
 ):
-    """
-    列表转嵌套树
-    :param arr: 传入的list
-    :param parent_name: 关系的key名
-    :param children_name: 嵌套数据使用的key名
-    :return:
-    """
-    # 1. 将列表转换成字典，列表中元素的唯一标识作为key，列表元素作为value
-    menu_map = {item["id"]: item for item in arr}
-
-    tree = []
-    for item in arr:
-        if item.get(parent_name) is None:
-            # 根节点
-            tree.append(item)
-        else:
-            menu_item = menu_map.get(item[parent_name])
-            # 子节点
-            if menu_item.get(children_name) is None:
-                menu_item[children_name] = []
-            menu_item[children_name].append(item)
-    return tree
+    if not await token_revocations.revoke(credentials.credentials):
+        raise HTTPException(401, "用户认证失败")
+    return schema.Result.ok()
 
 
 @auth.get("/me", response_model=schema.Result[schema.Info])
-async def info(obj: model.User = Depends(deps.jwt_auth)):
-    obj = await model.User.get(id=obj.id).prefetch_related("roles", "active_role")
-    if not obj.is_superuser:
-        if role := await obj.active_role.first():
-            result = await role.prefetch_related("menus").values()
-    else:
-        result = await model.Menu.filter().all().values()
-    # 过滤出 按钮权限
-    permissions = [item["permission"] for item in result if item["type"] == 3]
-    menus = [item for item in result if item["type"] != 3]
-    # menus 转 tree
-    setattr(obj, "menus", list2tree(menus))
-    setattr(obj, "permissions", permissions)
+async def info(principal: deps.Principal = Depends(deps.jwt_auth)):
+    # 用户、拥有角色、当前角色一次关联查询，每个角色一行
+    rows = await model.User.filter(id=principal.id).values(
+        "id",
+        "username",
+        "last_login",
+        "is_staff",
+        "is_superuser",
+        "avatar",
+        "active_role_id",
+        role_id="roles__id",
+        role_name="roles__name",
+        role_remark="roles__remark",
+        active_role_name="active_role__name",
+        active_role_remark="active_role__remark",
+    )
+    if not rows:
+        return schema.Result.error("用户不存在")
+    user = rows[0]
+    roles = [
+        schema.Role(id=row["role_id"], name=row["role_name"], remark=row["role_remark"])
+        for row in rows
+        if row["role_id"] is not None
+    ]
+    active_role = None
+    if user["active_role_id"] is not None:
+        active_role = schema.Role(
+            id=user["active_role_id"],
+            name=user["active_role_name"],
+            remark=user["active_role_remark"],
+        )
 
-    return schema.Result.ok(obj)
+    # 菜单树与按钮权限按角色缓存，菜单变更时失效
+    if user["is_superuser"]:
+        bundle = await menu_tree_cache.bundle()
+    elif active_role:
+        bundle = await menu_tree_cache.bundle(active_role.id)
+    else:
+        bundle = MenuBundle(menus=[], permissions=[])
+
+    return schema.Result.ok(
+        schema.Info(
+            id=user["id"],
+            username=user["username"],
+            password=None,
+            last_login=user["last_login"],
+            is_staff=user["is_staff"],
+            is_superuser=user["is_superuser"],
+            avatar=user["avatar"],
+            roles=roles,
+            active_role=active_role,
+            menus=bundle.menus,
+            permissions=bundle.permissions,
+        )
+    )
 
 
 user = APIRouter(
@@ -115,38 +238,118 @@ user = APIRouter(
 async def reset_passwd(id: int) -> schema.Result[schema.User]:
     obj = await model.User.get_or_none(id=id)
     if obj:
-        obj.password = security.get_password_hash("123456")
-        await obj.save()
+        obj.password = await security.async_get_password_hash("123456")
+        obj.token_version += 1
+        # 只写修改的列，避免用读取时的旧值覆盖期间批量写入的 last_login
+        await obj.save(update_fields=["password", "token_version"])
+        await deps.principal_invalidations.invalidate(obj.username)
         return schema.Result.ok()
     return schema.Result.error("更新失败")
 
 
 @user.post("/assign/role", summary="分配角色", tags=["权限相关"])
-@atomic()
 async def assign_role(payload: schema.AssignRole) -> schema.Result:
-    obj = await model.User.get_or_none(id=payload.user_id)
-    if not obj:
-        return schema.Result.error("用户不存在")
-
-    # 检查所有角色是否存在
-    existing_roles = await model.Role.filter(id__in=payload.role_ids).all()
-    if len(existing_roles) != len(payload.role_ids):
-        return schema.Result.error("部分角色不存在")
-    # 删除角色
-    await obj.roles.clear()
-    # 批量添加角色
-    await obj.roles.add(*existing_roles)
+    async with in_transaction():
+        obj = await model.User.get_or_none(id=payload.user_id)
+        if not obj:
+            return schema.Result.error("用户不存在")
+
+        # 检查所有角色是否存在
+        existing_roles = await model.Role.filter(id__in=payload.role_ids).all()
+        if len(existing_roles) != len(payload.role_ids):
+            return schema.Result.error("部分角色不存在")
+        # 删除角色
+        await obj.roles.clear()
+        # 批量添加角色
+        await obj.roles.add(*existing_roles)
+        obj.token_version += 1
+        await obj.save(update_fields=["token_version"])
+    # 事务提交后再失效，避免期间的请求把旧角色重新写入缓存
+    await deps.principal_invalidations.invalidate(obj.username)
 
     return schema.Result.ok()
 
 
-@user.get("/{id}", summary="通过ID查询详情")
-async def query_user_by_id(id: int) -> schema.Result[schema.User]:
-    obj = await model.User.get_or_none(id=id)
+@user.post("/import", summary="批量导入用户，请求体为 CSV 或 NDJSON")
+async def import_users(
+    request: Request,
+    format: schema.DataFormat | None = Query(
+        None, description="数据格式，为空时按 Content-Type 判断，默认 csv"
+    ),
+) -> schema.Result[schema.UserImportResult]:
+    if format is None:
+        content_type = request.headers.get("content-type", "")
+        if "ndjson" in content_type or "jsonl" in content_type:
+            format = schema.DataFormat.NDJSON
+        else:
+            format = schema.DataFormat.CSV
+    result = await UserImporter().run(request.stream(), format)
+    return schema.Result.ok(result)
+
+
+# 权限策略按 keyMatch2 匹配，/User/:id 会匹配任意单段路径，导出接口使用两段路径
+@user.get("/export/all", summary="流式导出全部用户，不包含密码")
+async def export_users(
+    format: schema.DataFormat = Query(schema.DataFormat.NDJSON, description="数据格式"),
+    gzip: bool = Query(False, description="是否 gzip 压缩"),
+):
+    return export_response("users", iter_users(), USER_EXPORT_FIELDS, format, gzip)
+
+
+@user.patch("/batch/update", summary="批量更新数据")
+async def update_users_by_ids(payload: schema.UserBatchUpdate) -> schema.Result[int]:
+    data = payload.data.model_dump(
+        exclude_unset=True, exclude={"id", "username", "password"}
+    )
+    if not data:
+        return schema.Result.error("没有需要更新的字段")
+    queryset = model.User.filter(id__in=payload.ids)
+    usernames = cast(list[str], await queryset.values_list("username", flat=True))
+    count = await queryset.update(**data, token_version=F("token_version") + 1)
+    await deps.principal_invalidations.invalidate(*usernames)
+    return schema.Result.ok(count)
+
+
+@user.delete("/batch/delete", summary="批量删除数据")
+async def delete_users_by_ids(payload: schema.BatchIds) -> schema.Result[int]:
+    queryset = model.User.filter(id__in=payload.ids)
+    usernames = cast(list[str], await queryset.values_list("username", flat=True))
+    count = await queryset.delete()
+    await deps.principal_invalidations.invalidate(*usernames)
+    return schema.Result.ok(count)
+
+
+@user.get("/batch/query", summary="按ID批量查询", response_model_exclude_unset=True)
+async def query_users_by_ids(
+    ids: list[int] = Query(
+        ..., min_length=1, max_length=BATCH_MAX_IDS, description="ID列表，按顺序返回"
+    ),
+    fields: list[schema.UserColumnEnum] | None = Query(
+        None, description="返回字段，为空时返回除密码外的全部字段，始终包含 id"
+    ),
+) -> schema.BatchResult[schema.User]:
+    data, missing = await fetch_by_ids(
+        model.User.all(), ids, fields or list(schema.UserColumnEnum)
+    )
+    return schema.BatchResult.ok(data, missing=missing)
+
+
+@user.get("/{id}", summary="通过ID查询详情", response_model_exclude_unset=True)
+async def query_user_by_id(
+    id: int,
+    fields: list[schema.UserColumnEnum] | None = Query(
+        None, description="返回字段，为空时返回除密码外的全部字段"
+    ),
+) -> schema.Result[schema.User]:
+    obj = (
+        await model.User.filter(id=id)
+        .first()
+        .values(*(fields or list(schema.UserColumnEnum)))
+    )
     return schema.Result.ok(obj)
 
 
-@user.get("", summary="分页条件查询")
+@user.get("", summary="分页条件查询", response_model_exclude_unset=True)
 async def query_user_all_by_limit(
     query: schema.UserQueryParams = Query(),
 ) -> schema.PageResult[schema.User]:
@@ -157,23 +360,41 @@ async def query_user_all_by_limit(
         order_by = []
     page_number = kwargs.pop("page_number")
     page_size = kwargs.pop("page_size")
-
-    total = await model.User.filter(**kwargs).count()
+    cursor = kwargs.pop("cursor", None)
+    count = kwargs.pop("count")
+    # 未指定字段时也按列查询，不返回密码哈希
+    fields = kwargs.pop("fields", None) or list(schema.UserColumnEnum)
+
+    total = await count_total(model.User, kwargs, count)
+    if cursor is not None:
+        try:
+            data, next_cursor = await keyset_paginate(
+                model.User.filter(**kwargs),
+                order_by[0] if order_by else "id",
+                cursor,
+                page_size,
+                fields,
+                unsortable=("password",),
+            )
+        except ValueError as e:
+            return schema.PageResult.error(str(e))
+        return schema.PageResult.ok(data=data, total=total, next_cursor=next_cursor)
     offset = (page_number - 1) * page_size
 
-    data = (
-        await model.User.filter(**kwargs)
+    queryset = (
+        model.User.filter(**kwargs)
         .offset(offset)
         .limit(page_size)
         .all()
         .order_by(*order_by)
     )
+    data = await queryset.values(*fields)
     return schema.PageResult.ok(data=data, total=total)
 
 
 @user.post("", summary="新增数据")
 async def create_user(instance: schema.User) -> schema.Result[schema.User]:
-    instance.password = security.get_password_hash("123456")
+    instance.password = await security.async_get_password_hash("123456")
     obj = await model.User.create(
         **instance.model_dump(
             exclude_unset=True,
@@ -191,9 +412,15 @@ async def update_user_by_id(
 ) -> schema.Result[schema.User]:
     obj = await model.User.get_or_none(id=id)
     if obj:
-        for field, value in instance.model_dump(exclude_unset=True).items():
+        username = obj.username
+        # last_login 由登录缓冲批量写入，不随整行保存
+        data = instance.model_dump(exclude_unset=True, exclude={"id", "last_login"})
+        for field, value in data.items():
             setattr(obj, field, value)
-        await obj.save()
+        obj.token_version += 1
+        await obj.save(update_fields=[*data, "token_version"])
+        # 保存后再失效，避免期间的请求把旧身份重新写入缓存
+        await deps.principal_invalidations.invalidate(username)
         return schema.Result.ok(obj)
     return schema.Result.error("更新失败")
 
@@ -203,6 +430,7 @@ async def delete_user_by_id(id: int) -> schema.Result[schema.User]:
     obj = await model.User.get_or_none(id=id)
     if obj:
         await obj.delete()
+        await deps.principal_invalidations.invalidate(obj.username)
         return schema.Result.ok(obj)
     return schema.Result.error("删除失败")
 
@@ -225,17 +453,90 @@ async def assign_menu(payload: schema.AssignMenu) -> schema.Result:
     await obj.menus.clear()
     # 批量添加角色
     await obj.menus.add(*existing_menus)
+    await menu_tree_cache.invalidate()
 
     return schema.Result.ok()
 
 
-@role.get("/{id}", summary="通过ID查询详情")
-async def query_role_by_id(id: int) -> schema.Result[schema.Role]:
-    obj = await model.Role.get_or_none(id=id)
+@role.get("/export/all", summary="流式导出全部角色")
+async def export_roles(
+    format: schema.DataFormat = Query(schema.DataFormat.NDJSON, description="数据格式"),
+    gzip: bool = Query(False, description="是否 gzip 压缩"),
+):
+    return export_response("roles", iter_roles(), ROLE_EXPORT_FIELDS, format, gzip)
+
+
+@role.get("/policy/export", summary="流式导出全部接口权限策略", tags=["权限相关"])
+async def export_policies(
+    format: schema.DataFormat = Query(schema.DataFormat.NDJSON, description="数据格式"),
+    gzip: bool = Query(False, description="是否 gzip 压缩"),
+):
+    return export_response(
+        "policies", iter_policies(), POLICY_EXPORT_FIELDS, format, gzip
+    )
+
+
+@role.patch("/batch/update", summary="批量更新数据")
+async def update_roles_by_ids(payload: schema.RoleBatchUpdate) -> schema.Result[int]:
+    data = payload.data.model_dump(exclude_unset=True, exclude={"id"})
+    if not data:
+        return schema.Result.error("没有需要更新的字段")
+    count = await model.Role.filter(id__in=payload.ids).update(**data)
+    return schema.Result.ok(count)
+
+
+@role.delete("/batch/delete", summary="批量删除数据")
+@atomic()
+async def delete_roles_by_ids(
+    request: Request, payload: schema.BatchIds
+) -> schema.Result[int]:
+    # delete() 返回的行数包含级联删除的关联表记录，先取出实际存在的角色
+    ids = await model.Role.filter(id__in=payload.ids).values_list("id", flat=True)
+    if ids:
+        await model.Role.filter(id__in=ids).delete()
+        # 一次删除这些角色的全部接口策略
+        enforcer = request.app.state.enforcer
+        rules = [
+            rule
+            for role_id in ids
+            for rule in enforcer.get_filtered_policy(0, str(role_id))
+        ]
+        if rules:
+            await enforcer.remove_policies(rules)
+        await deps.principal_invalidations.clear()
+        await menu_tree_cache.invalidate()
+    return schema.Result.ok(len(ids))
+
+
+@role.get("/batch/query", summary="按ID批量查询", response_model_exclude_unset=True)
+async def query_roles_by_ids(
+    ids: list[int] = Query(
+        ..., min_length=1, max_length=BATCH_MAX_IDS, description="ID列表，按顺序返回"
+    ),
+    fields: list[schema.RoleColumnEnum] | None = Query(
+        None, description="返回字段，为空时返回全部字段，始终包含 id"
+    ),
+) -> schema.BatchResult[schema.Role]:
+    data, missing = await fetch_by_ids(model.Role.all(), ids, fields)
+    return schema.BatchResult.ok(data, missing=missing)
+
+
+@role.get("/{id}", summary="通过ID查询详情", response_model_exclude_unset=True)
+async def query_role_by_id(
+    id: int,
+    fields: list[schema.RoleColumnEnum] | None = Query(
+        None, description="返回字段，为空时返回全部字段"
+    ),
+) -> schema.Result[schema.Role]:
+    obj: dict | model.Role | None
+    if fields:
+        obj = await model.Role.filter(id=id).first().values(*fields)
+    else:
+        obj = await model.Role.get_or_none(id=id)
     return schema.Result.ok(obj)
 
 
-@role.get("", summary="分页条件查询")
+@role.get("", summary="分页条件查询", response_model_exclude_unset=True)
 async def query_role_all_by_limit(
     query: schema.RoleQueryParams = Query(),
 ) -> schema.PageResult[schema.Role]:
@@ -246,17 +547,36 @@ async def query_role_all_by_limit(
         order_by = []
     page_number = kwargs.pop("page_number")
     page_size = kwargs.pop("page_size")
-
-    total = await model.Role.filter(**kwargs).count()
+    cursor = kwargs.pop("cursor", None)
+    count = kwargs.pop("count")
+    fields = kwargs.pop("fields", None)
+
+    total = await count_total(model.Role, kwargs, count)
+    if cursor is not None:
+        try:
+            data, next_cursor = await keyset_paginate(
+                model.Role.filter(**kwargs),
+                order_by[0] if order_by else "id",
+                cursor,
+                page_size,
+                fields,
+            )
+        except ValueError as e:
+            return schema.PageResult.error(str(e))
+        return schema.PageResult.ok(data=data, total=total, next_cursor=next_cursor)
     offset = (page_number - 1) * page_size
 
-    data = (
-        await model.Role.filter(**kwargs)
+    queryset = (
+        model.Role.filter(**kwargs)
         .offset(offset)
         .limit(page_size)
         .all()
         .order_by(*order_by)
     )
+    if fields:
+        data = await queryset.values(*fields)
+    else:
+        data = await queryset
     return schema.PageResult.ok(data=data, total=total)
 
 
@@ -285,6 +605,9 @@ async def delete_role_by_id(id: int) -> schema.Result[schema.Role]:
     obj = await model.Role.get_or_none(id=id)
     if obj:
         await obj.delete()
+        # 删除角色会级联影响用户的当前角色，直接清空身份缓存
+        await deps.principal_invalidations.clear()
+        await menu_tree_cache.invalidate()
         return schema.Result.ok(obj)
     return schema.Result.error("删除失败")
 
@@ -292,28 +615,83 @@ async def delete_role_by_id(id: int) -> schema.Result[schema.Role]:
 menu = APIRouter(prefix="/Menu", tags=["Menu"])
 
 
+@menu.get("/batch/query", summary="按ID批量查询", response_model_exclude_unset=True)
+async def query_menus_by_ids(
+    ids: list[int] = Query(
+        ..., min_length=1, max_length=BATCH_MAX_IDS, description="ID列表，按顺序返回"
+    ),
+    fields: list[schema.MenuColumnEnum] | None = Query(
+        None, description="返回字段，为空时返回全部字段，始终包含 id"
+    ),
+) -> schema.BatchResult[schema.Menu]:
+    data, missing = await fetch_by_ids(model.Menu.all(), ids, fields)
+    return schema.BatchResult.ok(data, missing=missing)
+
+
 @menu.get("/{id}", summary="通过ID查询详情")
 async def query_menu_by_id(id: int) -> schema.Result[schema.Menu]:
     obj = await model.Menu.get_or_none(id=id)
     return schema.Result.ok(obj)
 
 
-@menu.get("", summary="分页条件查询 -> 返回树结构")
-async def query_menu_all_by_limit() -> schema.PageResult[schema.MenuTree]:
-    total = await model.Menu.all().count()
-    data = await model.Menu.all().order_by("-created_at").values()
-    return schema.PageResult.ok(list2tree(data), total=total)
+@menu.get("/{id}/subtree", summary="查询菜单及其子孙菜单 -> 返回树结构")
+async def query_menu_subtree(
+    id: int,
+    depth: int | None = Query(
+        None, ge=1, description="向下查询的层数，为空时查询全部子孙菜单"
+    ),
+) -> schema.PageResult[schema.MenuTree]:
+    obj = await model.Menu.get_or_none(id=id)
+    if not obj:
+        return schema.PageResult.error("菜单不存在")
+    query = model.Menu.filter(Q(id=id) | Q(tree_path__startswith=obj.subtree_path))
+    if depth:
+        query = query.filter(depth__lte=obj.depth + depth)
+    data = await query.order_by("-created_at").values()
+    return schema.PageResult.ok(list2tree(data), total=len(data))
+
+
+@menu.get("/{id}/ancestors", summary="查询祖先菜单，从根菜单开始")
+async def query_menu_ancestors(id: int) -> schema.Result[list[schema.Menu]]:
+    obj = await model.Menu.get_or_none(id=id)
+    if not obj:
+        return schema.Result.error("菜单不存在")
+    data = await model.Menu.filter(id__in=obj.ancestor_ids).order_by("depth")
+    return schema.Result.ok(data)
+
+
+@menu.get(
+    "",
+    summary="分页条件查询 -> 返回树结构",
+    response_model=schema.PageResult[schema.MenuTree],
+)
+async def query_menu_all_by_limit(
+    request: Request,
+    role_id: int | None = Query(
+        None, alias="roleId", description="角色ID，为空时返回全部菜单"
+    ),
+):
+    etag, body = await menu_tree_cache.get(role_id)
+    headers = {"ETag": etag}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
 
 
 @menu.post("", summary="新增数据")
 async def create_menu(instance: schema.Menu) -> schema.Result[schema.Menu]:
     if instance.parent_id == 0:
         instance.parent_id = None
-    obj = await model.Menu.create(**instance.model_dump(exclude_unset=True))
+    try:
+        obj = await model.Menu.create(**instance.model_dump(exclude_unset=True))
+    except ValidationError as e:
+        return schema.Result.error(str(e))
+    await menu_tree_cache.invalidate()
     return schema.Result.ok(obj)
 
 
 @menu.patch("/{id}", summary="更新数据")
+@atomic()
 async def update_menu_by_id(
     id: int, instance: schema.Menu
 ) -> schema.Result[schema.Menu]:
@@ -323,7 +701,11 @@ async def update_menu_by_id(
             instance.parent_id = None
         for field, value in instance.model_dump(exclude_unset=True).items():
             setattr(obj, field, value)
-        await obj.save()
+        try:
+            await obj.save()
+        except ValidationError as e:
+            return schema.Result.error(str(e))
+        await menu_tree_cache.invalidate()
         return schema.Result.ok(obj)
     return schema.Result.error("更新失败")
 
@@ -333,32 +715,62 @@ async def delete_menu_by_id(id: int) -> schema.Result[schema.Menu]:
     obj = await model.Menu.get_or_none(id=id)
     if obj:
         await obj.delete()
+        await menu_tree_cache.invalidate()
         return schema.Result.ok(obj)
     return schema.Result.error("删除失败")
 
 
 @role.post("/assign/route", summary="分配接口(权限)", tags=["权限相关"])
 @atomic()
-async def assign_route(request: Request, payload: schema.AssignRoute) -> schema.Result:
+async def assign_route(
+    request: Request, payload: schema.AssignRoute
+) -> schema.Result[schema.AssignRouteResult]:
     obj = await model.Role.get_or_none(id=payload.role_id)
     if not obj:
         return schema.Result.error("角色不存在")
-    valid_routes = {route.path: route.method for route in request.app.routes}
+    valid_routes = request.app.state.route_catalog
 
-    # 使用集合存储待添加的策略
-    policies_to_add = set()
+    # 使用集合存储目标策略
+    role_id = str(payload.role_id)
+    policies: set[tuple[str, ...]] = set()
 
     # 收集策略
     for route in payload.routes:
-        if route.path in valid_routes and route.method == valid_routes[route.path]:
-            policy = (str(payload.role_id), route.path, route.method)
-            policies_to_add.add(policy)
+        if (route.path, route.method) in valid_routes:
+            policies.add((role_id, route.path, route.method))
         else:
             return schema.Result.error("无效的路径或方法")
 
-    # 一次性批量添加所有策略
-    if policies_to_add:
-        enforcer = request.app.state.enforcer
-        await enforcer.remove_filtered_policy(0, str(payload.role_id))
-        await enforcer.add_policies(list(policies_to_add))
-    return schema.Result.ok()
+    # 与角色现有策略求差集，只删除、新增发生变化的策略
+    enforcer = request.app.state.enforcer
+    current = {tuple(rule) for rule in enforcer.get_filtered_policy(0, role_id)}
+    removed = sorted(current - policies)
+    added = sorted(policies - current)
+    if removed:
+        await enforcer.remove_policies([list(rule) for rule in removed])
+    if added:
+        await enforcer.add_policies([list(rule) for rule in added])
+    return schema.Result.ok(
+        schema.AssignRouteResult(
+            added=[
+                schema.RoutePolicy(path=path, method=method)
+                for _, path, method in added
+            ],
+            removed=[
+                schema.RoutePolicy(path=path, method=method)
+                for _, path, method in removed
+            ],
+        )
+    )
+
+
+disk = APIRouter(
+    prefix="/disk",
+    tags=["Disk"],
+    dependencies=[Depends(deps.check_permission)] if DISK_REQUIRE_PERMISSION else [],
+)
+
+
+@disk.api_route("/{key:path}", methods=["GET", "HEAD"], summary="下载文件")
+async def download(request: Request, key: str):
+    return await file_response(request, key)
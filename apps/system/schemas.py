@@ -7,6 +7,8 @@ from pydantic import HttpUrl, field_validator
 
 from core.schemas import (
     BaseModel,
+    BatchResult,
+    CountMode,
     Field,
     PageResult,
     RequestSchema,
@@ -15,6 +17,12 @@ from core.schemas import (
     datetime,
     to_camel,
 )
+from core.settings import BATCH_MAX_IDS
+
+
+def to_policy_path(path: str) -> str:
+    """路由模板转换为策略路径, /User/{id} -> /User/:id"""
+    return re.sub(r"\{.*?\}", ":id", path)
 
 
 class UploadFilePayload(RequestSchema):
@@ -25,6 +33,24 @@ class UploadFilePayload(RequestSchema):
 class UploadFileResult(ResponseSchema):
     url: HttpUrl
     key: str | None = None
+    sha256: str | None = Field(None, description="文件内容哈希")
+    size: int | None = Field(None, description="文件大小（字节）")
+
+
+class UploadSessionPayload(RequestSchema):
+    """创建分片上传会话"""
+
+    filename: str | None = Field(None, description="原始文件名")
+    size: int = Field(..., ge=0, description="文件大小（字节）")
+    key: str | None = Field(None, description="保存路径，为空时按内容哈希保存")
+
+
+class UploadSessionResult(ResponseSchema):
+    """分片上传会话"""
+
+    upload_id: str = Field(..., description="会话ID")
+    offset: int = Field(..., description="已上传的字节数，续传时从该位置开始")
+    size: int = Field(..., description="文件大小（字节）")
 
 
 class Login(RequestSchema):
@@ -44,13 +70,22 @@ class Route(RequestSchema):
     @field_validator("path")
     @classmethod
     def path_validator(cls, v):
-        return re.sub(r"\{.*?\}", ":id", v)
+        return to_policy_path(v)
 
 
 class Token(ResponseSchema):
     """登录成功返回token"""
 
     token: str
+    refresh_token: str | None = Field(
+        None, description="刷新token，无状态认证模式下返回"
+    )
+
+
+class RefreshToken(RequestSchema):
+    """刷新token"""
+
+    refresh_token: str = Field(..., description="刷新token")
 
 
 class AssignRole(RequestSchema):
@@ -74,6 +109,28 @@ class AssignRoute(RequestSchema):
     role_id: int = Field(..., description="角色ID")
 
 
+class RoutePolicy(ResponseSchema):
+    """接口策略"""
+
+    path: str = Field(..., description="路由地址")
+    method: str = Field(..., description="请求方法")
+
+
+class AssignRouteResult(ResponseSchema):
+    """分配接口结果，只包含实际发生变化的策略"""
+
+    added: list[RoutePolicy] = Field(default_factory=list, description="新增的策略")
+    removed: list[RoutePolicy] = Field(default_factory=list, description="删除的策略")
+
+
+class BatchIds(RequestSchema):
+    """批量操作的ID列表"""
+
+    ids: list[int] = Field(
+        ..., min_length=1, max_length=BATCH_MAX_IDS, description="ID列表"
+    )
+
+
 class UserFieldEnum(StrEnum):
     ID_ASC = "id"
     ID_DESC = "-id"
@@ -85,6 +142,15 @@ class UserFieldEnum(StrEnum):
     ROLES_DESC = "-roles"
 
 
+class UserColumnEnum(StrEnum):
+    ID = "id"
+    USERNAME = "username"
+    LAST_LOGIN = "last_login"
+    IS_STAFF = "is_staff"
+    IS_SUPERUSER = "is_superuser"
+    AVATAR = "avatar"
+
+
 class User(BaseModel):
     id: Optional[int] = Field(None)
     username: Optional[str] = Field(None)
@@ -114,6 +180,62 @@ class UserQueryParams(User):
     order_by: Optional[list[UserFieldEnum]] = Field(
         None, description="排序字段查询时使用"
     )
+    cursor: Optional[str] = Field(
+        None,
+        description="游标分页：首页传空字符串，之后传上一页返回的 nextCursor，"
+        "此时忽略页码且只使用第一个排序字段",
+    )
+    count: CountMode = Field(
+        CountMode.EXACT,
+        description="总数统计方式：exact 精确、cached 缓存、none 不统计",
+    )
+    fields: Optional[list[UserColumnEnum]] = Field(
+        None, description="返回字段，为空时返回除密码外的全部字段"
+    )
+
+
+class UserBatchUpdate(BatchIds):
+    """批量更新用户，不支持修改 id、username、password"""
+
+    data: User = Field(..., description="更新的字段")
+
+
+class DataFormat(StrEnum):
+    """导入导出的数据格式"""
+
+    CSV = "csv"
+    NDJSON = "ndjson"
+
+
+class UserImportRow(RequestSchema):
+    """导入的用户，CSV 中 roles 使用 ; 分隔"""
+
+    username: str = Field(..., min_length=1, max_length=32, description="用户名")
+    password: str | None = Field(None, description="密码，为空时为 123456")
+    is_staff: bool = Field(False, description="是否是管理员")
+    is_superuser: bool = Field(False, description="是否是超级管理员")
+    avatar: str | None = Field(None, max_length=128, description="头像")
+    roles: list[str] = Field(default_factory=list, description="角色名列表")
+    active_role: str | None = Field(None, description="当前角色名")
+
+    @field_validator("roles", mode="before")
+    @classmethod
+    def roles_validator(cls, v):
+        if isinstance(v, str):
+            return [name.strip() for name in v.split(";") if name.strip()]
+        return v
+
+
+class UserImportError(ResponseSchema):
+    line: int = Field(..., description="行号")
+    username: str | None = Field(None, description="用户名")
+    message: str = Field(..., description="错误信息")
+
+
+class UserImportResult(ResponseSchema):
+    created: int = Field(0, description="导入成功数")
+    failed: int = Field(0, description="导入失败数")
+    errors: list[UserImportError] = Field(default_factory=list, description="失败的行")
 
 
 class RoleFieldEnum(StrEnum):
@@ -125,6 +247,12 @@ class RoleFieldEnum(StrEnum):
     MENUS_DESC = "-menus"
 
 
+class RoleColumnEnum(StrEnum):
+    ID = "id"
+    NAME = "name"
+    REMARK = "remark"
+
+
 class Role(BaseModel):
     id: Optional[int] = Field(None)
     name: Optional[str] = Field(None)
@@ -136,12 +264,30 @@ class Role(BaseModel):
     }
 
 
+class RoleBatchUpdate(BatchIds):
+    """批量更新角色，不支持修改 id"""
+
+    data: Role = Field(..., description="更新的字段")
+
+
 class RoleQueryParams(Role):
     page_number: int = Field(1, description="页码")
     page_size: int = Field(10, description="每页数量")
     order_by: Optional[list[RoleFieldEnum]] = Field(
         None, description="排序字段查询时使用"
     )
+    cursor: Optional[str] = Field(
+        None,
+        description="游标分页：首页传空字符串，之后传上一页返回的 nextCursor，"
+        "此时忽略页码且只使用第一个排序字段",
+    )
+    count: CountMode = Field(
+        CountMode.EXACT,
+        description="总数统计方式：exact 精确、cached 缓存、none 不统计",
+    )
+    fields: Optional[list[RoleColumnEnum]] = Field(
+        None, description="返回字段，为空时返回全部字段"
+    )
 
 
 class MenuFieldEnum(StrEnum):
@@ -167,6 +313,18 @@ class MenuFieldEnum(StrEnum):
     TYPE_DESC = "-type"
 
 
+class MenuColumnEnum(StrEnum):
+    ID = "id"
+    NAME = "name"
+    PARENT_ID = "parent_id"
+    PATH = "path"
+    COMPONENT = "component"
+    META = "meta"
+    REDIRECT = "redirect"
+    PERMISSION = "permission"
+    TYPE = "type"
+
+
 class Menu(BaseModel):
     id: Optional[int] = Field(None)
     name: Optional[str] = Field(None)
@@ -203,4 +361,4 @@ class MenuTree(Menu):
     children: list["MenuTree"] | None = Field(None)
 
 
-__all__ = ["PageResult", "Result"]
+__all__ = ["BatchResult", "PageResult", "Result"]
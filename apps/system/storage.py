@@ -0,0 +1,389 @@
+"""文件存储"""
+
+import asyncio
+import contextlib
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import stat
+import time
+import uuid
+from email.utils import parsedate
+from typing import AsyncIterator, BinaryIO, Callable, Coroutine
+
+from fastapi import HTTPException
+from fastapi.routing import APIRoute
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers
+from starlette.requests import Request
+from starlette.responses import FileResponse, Response
+from starlette.types import Message, Receive, Scope, Send
+
+from core.settings import (
+    DISK_PATH,
+    UPLOAD_CHUNK_SIZE,
+    UPLOAD_CLEANUP_INTERVAL,
+    UPLOAD_MAX_SIZE,
+    UPLOAD_SESSION_TTL,
+)
+
+logger = logging.getLogger(__name__)
+
+# 上传中的临时文件与分片上传会话，与正式文件位于同一文件系统，完成后直接重命名
+UPLOAD_TMP_PATH = os.path.join(DISK_PATH, ".uploads")
+# multipart 表单中除文件内容外的边界、字段等开销（字节）
+FORM_OVERHEAD = 64 * 1024
+
+
+def resolve_key(key: str) -> str:
+    """
+    文件 key 转为磁盘路径，key 不能指向 DISK_PATH 之外
+    :param key: 相对 DISK_PATH 的文件路径
+    """
+    root = os.path.realpath(DISK_PATH)
+    path = os.path.realpath(os.path.join(root, key))
+    if not path.startswith(root + os.sep) or path.startswith(
+        os.path.realpath(UPLOAD_TMP_PATH) + os.sep
+    ):
+        raise HTTPException(400, "无效的文件路径")
+    return path
+
+
+def content_key(digest: str, filename: str | None) -> str:
+    """按内容哈希生成 key，相同内容的文件只保存一份"""
+    _, ext = os.path.splitext(filename or "")
+    return f"{digest[:2]}/{digest}{ext.lower()}"
+
+
+def _tmp_path(name: str) -> str:
+    os.makedirs(UPLOAD_TMP_PATH, exist_ok=True)
+    return os.path.join(UPLOAD_TMP_PATH, name)
+
+
+def _commit(tmp: str, key: str | None, digest: str, filename: str | None) -> str:
+    """临时文件移动到 key 对应路径，未指定 key 时按内容哈希去重"""
+    if key is None:
+        key = content_key(digest, filename)
+        path = resolve_key(key)
+        if os.path.exists(path):
+            os.remove(tmp)
+            return key
+    else:
+        path = resolve_key(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(tmp, path)
+    return key
+
+
+def _copy(
+    src: BinaryIO, key: str | None, filename: str | None, max_size: int
+) -> tuple[str, str, int]:
+    tmp = _tmp_path(f"{uuid.uuid4().hex}.part")
+    digest, size = hashlib.sha256(), 0
+    try:
+        with open(tmp, "wb") as dst:
+            while chunk := src.read(UPLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if size > max_size:
+                    raise HTTPException(413, "文件过大")
+                digest.update(chunk)
+                dst.write(chunk)
+        return _commit(tmp, key, digest.hexdigest(), filename), digest.hexdigest(), size
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+async def save_file(
+    src: BinaryIO,
+    key: str | None = None,
+    filename: str | None = None,
+    max_size: int = UPLOAD_MAX_SIZE,
+) -> tuple[str, str, int]:
+    """
+    分块复制文件并计算 sha256，整个复制过程在线程池中执行，不阻塞事件循环
+    :param src: 源文件对象（如 UploadFile.file）
+    :param key: 保存路径，为空时按内容哈希保存并去重
+    :param filename: 原始文件名，用于保留扩展名
+    :param max_size: 最大字节数，超出返回 413
+    :return: (key, sha256, 文件大小)
+    """
+    if key is not None:
+        resolve_key(key)
+    return await run_in_threadpool(_copy, src, key, filename, max_size)
+
+
+class UploadRoute(APIRoute):
+    """
+    表单上传接口：FastAPI 在调用接口前会把整个请求体解析到临时文件，
+    因此在解析前按 Content-Length 拒绝超限请求，分块传输时按已读取的字节数拒绝
+    """
+
+    max_size = UPLOAD_MAX_SIZE + FORM_OVERHEAD
+
+    def get_route_handler(self) -> Callable[[Request], Coroutine[None, None, Response]]:
+        handler = super().get_route_handler()
+        max_size = self.max_size
+
+        async def route_handler(request: Request) -> Response:
+            length = request.headers.get("content-length", "")
+            if length.isdigit() and int(length) > max_size:
+                raise HTTPException(413, "文件过大")
+            received = 0
+
+            async def receive() -> Message:
+                nonlocal received
+                message = await request.receive()
+                received += len(message.get("body", b""))
+                if received > max_size:
+                    raise HTTPException(413, "文件过大")
+                return message
+
+            return await handler(Request(request.scope, receive))
+
+        return route_handler
+
+
+class UploadSession:
+    """
+    分片上传（断点续传）会话
+
+    数据写入 UPLOAD_TMP_PATH 下的 {id}.part，元数据保存在 {id}.json，
+    多进程共享同一目录即可续传；已上传的字节数即 .part 文件大小。
+    写入分片、完成上传时对 .part 加文件锁，同一会话同时只有一个请求写入，
+    超过 UPLOAD_SESSION_TTL 未更新的会话由 run_upload_cleanup 删除
+    """
+
+    def __init__(self, id: str, filename: str | None, size: int, key: str | None):
+        self.id = id
+        self.filename = filename
+        self.size = size
+        self.key = key
+
+    @property
+    def path(self) -> str:
+        return _tmp_path(f"{self.id}.part")
+
+    @property
+    def offset(self) -> int:
+        """已上传的字节数"""
+        return os.path.getsize(self.path)
+
+    @classmethod
+    def create(
+        cls, filename: str | None, size: int, key: str | None = None
+    ) -> "UploadSession":
+        """
+        创建会话
+        :param filename: 原始文件名
+        :param size: 文件总大小
+        :param key: 保存路径，为空时按内容哈希保存并去重
+        """
+        if size > UPLOAD_MAX_SIZE:
+            raise HTTPException(413, "文件过大")
+        if key is not None:
+            resolve_key(key)
+        session = cls(uuid.uuid4().hex, filename, size, key)
+        with open(_tmp_path(f"{session.id}.json"), "w", encoding="utf-8") as f:
+            json.dump(
+                {"filename": filename, "size": size, "key": key}, f, ensure_ascii=False
+            )
+        open(session.path, "wb").close()
+        return session
+
+    @classmethod
+    def get(cls, id: str) -> "UploadSession":
+        if not id.isalnum():
+            raise HTTPException(404, "上传会话不存在")
+        try:
+            with open(_tmp_path(f"{id}.json"), encoding="utf-8") as f:
+                return cls(id, **json.load(f))
+        except FileNotFoundError:
+            raise HTTPException(404, "上传会话不存在") from None
+
+    def _lock(self, write: bool = False) -> BinaryIO:
+        """
+        打开 .part 文件并加排他锁（跨进程），会话正被其他请求写入时返回 409
+        :param write: 是否以追加方式打开
+        """
+        f: BinaryIO
+        try:
+            if write:
+                # 不使用 O_CREAT，会话完成或过期删除后不会重新创建文件
+                f = os.fdopen(os.open(self.path, os.O_WRONLY | os.O_APPEND), "ab")
+            else:
+                f = open(self.path, "rb")
+        except FileNotFoundError:
+            raise HTTPException(404, "上传会话不存在") from None
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            # 等待期间文件可能已完成上传被移走，此时打开的已不是会话文件
+            if os.fstat(f.fileno()).st_ino != os.stat(self.path).st_ino:
+                raise HTTPException(404, "上传会话不存在")
+        except BlockingIOError:
+            f.close()
+            raise HTTPException(409, "分片正在上传，请稍后重试") from None
+        except FileNotFoundError:
+            f.close()
+            raise HTTPException(404, "上传会话不存在") from None
+        except BaseException:
+            f.close()
+            raise
+        return f
+
+    async def append(self, offset: int, stream: AsyncIterator[bytes]) -> int:
+        """
+        从 offset 开始写入分片，offset 必须等于已上传的字节数
+        :param offset: 分片起始位置
+        :param stream: 请求体
+        :return: 写入后已上传的字节数
+        """
+        f = await run_in_threadpool(self._lock, True)
+        try:
+            # 持有锁后再校验位置，重试的请求不会重复追加同一分片
+            current = os.fstat(f.fileno()).st_size
+            if offset != current:
+                raise HTTPException(409, f"分片位置错误，已上传 {current} 字节")
+            buffer = bytearray()
+            async for chunk in stream:
+                current += len(chunk)
+                if current > self.size:
+                    raise HTTPException(413, "超出文件大小")
+                buffer += chunk
+                if len(buffer) >= UPLOAD_CHUNK_SIZE:
+                    await run_in_threadpool(f.write, bytes(buffer))
+                    buffer.clear()
+            if buffer:
+                await run_in_threadpool(f.write, bytes(buffer))
+        finally:
+            await run_in_threadpool(f.close)
+        return current
+
+    def _complete(self) -> tuple[str, str, int]:
+        with self._lock() as f:
+            size = os.fstat(f.fileno()).st_size
+            if size != self.size:
+                raise HTTPException(409, f"文件未上传完成，已上传 {size} 字节")
+            digest = hashlib.sha256()
+            while chunk := f.read(UPLOAD_CHUNK_SIZE):
+                digest.update(chunk)
+            key = _commit(self.path, self.key, digest.hexdigest(), self.filename)
+            os.remove(_tmp_path(f"{self.id}.json"))
+        return key, digest.hexdigest(), size
+
+    async def complete(self) -> tuple[str, str, int]:
+        """
+        校验大小并计算 sha256，移动到正式路径
+        :return: (key, sha256, 文件大小)
+        """
+        return await run_in_threadpool(self._complete)
+
+
+def purge_expired_uploads(ttl: int = UPLOAD_SESSION_TTL) -> int:
+    """
+    删除超过 ttl 秒未更新的上传会话，以及异常退出残留的临时文件
+    :param ttl: 会话有效期（秒）
+    :return: 删除的会话数
+    """
+    try:
+        entries = list(os.scandir(UPLOAD_TMP_PATH))
+    except FileNotFoundError:
+        return 0
+    # 会话 ID -> 最后更新时间，.part 与 .json 取较新者
+    updated: dict[str, float] = {}
+    for entry in entries:
+        id, ext = os.path.splitext(entry.name)
+        if ext in (".part", ".json"):
+            with contextlib.suppress(FileNotFoundError):
+                updated[id] = max(updated.get(id, 0), entry.stat().st_mtime)
+    deadline = time.time() - ttl
+    removed = 0
+    for id, mtime in updated.items():
+        if mtime >= deadline:
+            continue
+        part = os.path.join(UPLOAD_TMP_PATH, f"{id}.part")
+        try:
+            with open(part, "rb") as f:
+                # 正在写入的会话跳过
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                os.remove(part)
+        except BlockingIOError:
+            continue
+        except FileNotFoundError:
+            pass
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(os.path.join(UPLOAD_TMP_PATH, f"{id}.json"))
+        removed += 1
+    return removed
+
+
+async def run_upload_cleanup(interval: float = UPLOAD_CLEANUP_INTERVAL):
+    """后台定时清理过期的上传会话"""
+    while True:
+        try:
+            await run_in_threadpool(purge_expired_uploads)
+        except Exception:
+            logger.exception("清理过期上传会话失败")
+        await asyncio.sleep(interval)
+
+
+class DiskFileResponse(FileResponse):
+    """
+    文件响应：服务器支持 ASGI pathsend 扩展时由服务器直接发送文件（零拷贝），
+    否则按 chunk_size 分块读取发送；Range 请求由 FileResponse 处理
+    """
+
+    chunk_size = UPLOAD_CHUNK_SIZE
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        headers = Headers(scope=scope)
+        if (
+            "http.response.pathsend" in scope.get("extensions", {})
+            and "range" not in headers
+            and scope["method"] != "HEAD"
+        ):
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": self.status_code,
+                    "headers": self.raw_headers,
+                }
+            )
+            await send({"type": "http.response.pathsend", "path": str(self.path)})
+            return
+        await super().__call__(scope, receive, send)
+
+
+def _is_not_modified(response: Response, request: Request) -> bool:
+    if if_none_match := request.headers.get("if-none-match"):
+        etag = response.headers["etag"]
+        return etag in [tag.strip(" W/") for tag in if_none_match.split(",")]
+    if if_modified_since := parsedate(request.headers.get("if-modified-since", "")):
+        last_modified = parsedate(response.headers["last-modified"])
+        return last_modified is not None and if_modified_since >= last_modified
+    return False
+
+
+async def file_response(request: Request, key: str) -> Response:
+    """
+    下载文件，支持 Range 分段下载、ETag/Last-Modified 协商缓存（304）
+    :param request: 请求
+    :param key: 相对 DISK_PATH 的文件路径
+    """
+    path = resolve_key(key)
+    try:
+        stat_result = await run_in_threadpool(os.stat, path)
+    except FileNotFoundError:
+        raise HTTPException(404, "文件不存在") from None
+    if not stat.S_ISREG(stat_result.st_mode):
+        raise HTTPException(404, "文件不存在")
+    response = DiskFileResponse(path, stat_result=stat_result)
+    if _is_not_modified(response, request):
+        return Response(
+            status_code=304,
+            headers={key: response.headers[key] for key in ("etag", "last-modified")},
+        )
+    return response
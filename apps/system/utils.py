@@ -1,194 +1,543 @@
+import asyncio
+import hashlib
+import json
+import logging
+from datetime import datetime
+from pathlib import Path
+from typing import Iterable, NamedTuple, cast
+
+from pypika import Table
+from tortoise.expressions import Q
+from tortoise.fields.relational import ManyToManyFieldInstance
+from tortoise.models import Model
+from tortoise.transactions import in_transaction
+
 from apps.system import schemas
-from apps.system.models import Menu, MenuType, User
-from core.security import get_password_hash
+from apps.system.models import ChangeLog, Menu, MenuType, Role, User
+from apps.system.watcher import ORIGIN, ChangeLogReader
+from core.cache import LRUCache
+from core.security import get_password_hash, revoke_digest, revoke_token
+from core.settings import (
+    LAST_LOGIN_FLUSH_INTERVAL,
+    MENU_CACHE_SIZE,
+    MENU_CACHE_SYNC_INTERVAL,
+    POLICY_SYNC_INTERVAL,
+)
 
+logger = logging.getLogger(__name__)
 
-async def init_db():
-    if not await User.get_or_none(username="admin"):
-        # 1. 创建用户
-        await User.create(
-            username="admin",
-            password=get_password_hash("123456"),
-            is_superuser=True,
-            is_staff=True,
-        )
 
-        # 2. 创建菜单
-        root = await Menu.create(
-            name="系统管理",
-            path="/system",
-            component="",
-            permission="",
-            type=MenuType.DIRECTORY,
-            meta=schemas.MenuMeta(
-                title="系统管理",
-                icon="Management",
-            ).model_dump(),
-        )
-        user = await Menu.create(
-            name="用户管理",
-            path="/system/user",
-            parent=root,
-            component="/src/views/system/user/index.vue",
-            permission="",
-            type=MenuType.MENU,
-            meta=schemas.MenuMeta(
-                title="用户管理",
-            ).model_dump(),
-        )
-        role = await Menu.create(
-            name="角色管理",
-            path="/system/role",
-            parent=root,
-            component="/src/views/system/role/index.vue",
-            permission="",
-            type=MenuType.MENU,
-            meta=schemas.MenuMeta(
-                title="角色管理",
-            ).model_dump(),
-        )
+class LastLoginBuffer:
+    """
+    登录时间写缓冲：登录时只记录在内存中，后台按间隔合并为一条批量 UPDATE
+    """
 
-        menu = await Menu.create(
-            name="菜单管理",
-            path="/system/menu",
-            parent=root,
-            component="/src/views/system/menu/index.vue",
-            permission="",
-            type=MenuType.MENU,
-            meta=schemas.MenuMeta(
-                title="菜单管理",
-            ).model_dump(),
-        )
+    def __init__(self, interval: float = LAST_LOGIN_FLUSH_INTERVAL):
+        self.interval = interval
+        self._pending: dict[int, datetime] = {}
 
-        await Menu.create(
-            name="用户新增",
-            path="",
-            parent=user,
-            component="",
-            permission="user:add",
-            type=MenuType.BUTTON,
-            meta=schemas.MenuMeta(
-                title="用户新增",
-            ).model_dump(),
-        )
-        await Menu.create(
-            name="用户删除",
-            path="",
-            parent=user,
-            component="",
-            permission="user:delete",
-            type=MenuType.BUTTON,
-            meta=schemas.MenuMeta(
-                title="用户删除",
-            ).model_dump(),
-        )
-        await Menu.create(
-            name="用户修改",
-            path="",
-            parent=user,
-            component="",
-            permission="user:edit",
-            type=MenuType.BUTTON,
-            meta=schemas.MenuMeta(
-                title="用户修改",
-            ).model_dump(),
-        )
-        await Menu.create(
-            name="用户查询",
-            path="",
-            parent=user,
-            component="",
-            permission="user:query",
-            type=MenuType.BUTTON,
-            meta=schemas.MenuMeta(
-                title="用户查询",
-            ).model_dump(),
-        )
-        await Menu.create(
-            name="角色新增",
-            path="",
-            parent=role,
-            component="",
-            permission="role:add",
-            type=MenuType.BUTTON,
-            meta=schemas.MenuMeta(
-                title="角色新增",
-            ).model_dump(),
+    def record(self, user_id: int, at: datetime | None = None):
+        """
+        记录用户登录时间，同一用户在一个间隔内多次登录只保留最后一次
+        :param user_id: 用户ID
+        :param at: 登录时间，默认当前时间
+        """
+        self._pending[user_id] = at or datetime.now()
+
+    async def flush(self):
+        """写入缓冲中的登录时间"""
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        try:
+            await User.bulk_update(
+                [User(id=user_id, last_login=at) for user_id, at in pending.items()],
+                fields=["last_login"],
+                batch_size=500,
+            )
+        except Exception:
+            # 写入失败时放回缓冲，期间新记录的时间优先
+            self._pending = {**pending, **self._pending}
+            raise
+
+    async def run(self):
+        """后台定时写入"""
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("写入登录时间失败")
+
+
+last_login_buffer = LastLoginBuffer()
+
+
+def list2tree(
+    arr: list, parent_name: str = "parent_id", children_name: str = "children"
+):
+    """
+    列表转嵌套树
+    :param arr: 传入的list
+    :param parent_name: 关系的key名
+    :param children_name: 嵌套数据使用的key名
+    :return:
+    """
+    # 1. 将列表转换成字典，列表中元素的唯一标识作为key，列表元素作为value
+    menu_map = {item["id"]: item for item in arr}
+
+    tree = []
+    for item in arr:
+        menu_item = menu_map.get(item.get(parent_name))
+        if menu_item is None:
+            # 根节点（角色菜单中父菜单未分配时也作为根节点）
+            tree.append(item)
+        else:
+            # 子节点
+            if menu_item.get(children_name) is None:
+                menu_item[children_name] = []
+            menu_item[children_name].append(item)
+    return tree
+
+
+class MenuBundle(NamedTuple):
+    """角色的菜单树（不含按钮）与按钮权限"""
+
+    menus: list[schemas.MenuTree]
+    permissions: list[str]
+
+
+class MenuTreeCache:
+    """
+    菜单树缓存：按角色（None 为全部菜单，即超级管理员）缓存序列化后的 JSON 与 ETag，
+    以及 /me 使用的菜单树与按钮权限
+
+    菜单、角色菜单变更时调用 invalidate 清空本地缓存并写入一条 ChangeLog，
+    各进程轮询到新的变更日志（包括晚提交的）后清空本地缓存
+    """
+
+    topic = "menu"
+
+    def __init__(
+        self, interval: float = MENU_CACHE_SYNC_INTERVAL, maxsize: int = MENU_CACHE_SIZE
+    ):
+        self.interval = interval
+        # 本进程的变更在提交后也清空一次，避免提交前重建的缓存读到旧数据
+        self.log = ChangeLogReader(self.topic, skip_own=False)
+        # 本地缓存版本，每次清空时加一，构建期间版本变化时不写入缓存
+        self.version = 0
+        # 角色ID来自未登录也能访问的 /Menu，使用有界缓存
+        self._trees: LRUCache[int | None, tuple[str, bytes]] = LRUCache(maxsize)
+        self._bundles: LRUCache[int | None, MenuBundle] = LRUCache(maxsize)
+
+    async def get(self, role_id: int | None = None) -> tuple[str, bytes]:
+        """
+        获取菜单树
+        :param role_id: 角色ID，为空时返回全部菜单
+        :return: (ETag, 响应内容)
+        """
+        if (item := self._trees.get(role_id)) is not None:
+            return item
+        version = self.version
+        data = await self._load(role_id)
+        body = (
+            schemas.PageResult[schemas.MenuTree]
+            .ok(list2tree(data), total=len(data))
+            .model_dump_json(by_alias=True)
+            .encode()
         )
-        await Menu.create(
-            name="角色删除",
-            path="",
-            parent=role,
-            component="",
-            permission="role:delete",
-            type=MenuType.BUTTON,
-            meta=schemas.MenuMeta(
-                title="角色删除",
-            ).model_dump(),
+        item = (f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"', body)
+        # 构建期间发生变更时不写入缓存
+        if version == self.version:
+            self._trees.set(role_id, item)
+        return item
+
+    async def bundle(self, role_id: int | None = None) -> MenuBundle:
+        """
+        获取菜单树（不含按钮）与按钮权限
+        :param role_id: 角色ID，为空时返回全部菜单
+        """
+        if (item := self._bundles.get(role_id)) is not None:
+            return item
+        version = self.version
+        data = await self._load(role_id)
+        item = MenuBundle(
+            menus=[
+                schemas.MenuTree.model_validate(node)
+                for node in list2tree(
+                    [row for row in data if row["type"] != MenuType.BUTTON]
+                )
+            ],
+            permissions=[
+                row["permission"] for row in data if row["type"] == MenuType.BUTTON
+            ],
         )
-        await Menu.create(
-            name="角色修改",
-            path="",
-            parent=role,
-            component="",
-            permission="role:edit",
-            type=MenuType.BUTTON,
-            meta=schemas.MenuMeta(
-                title="角色修改",
-            ).model_dump(),
+        if version == self.version:
+            self._bundles.set(role_id, item)
+        return item
+
+    @staticmethod
+    async def _load(role_id: int | None) -> list[dict]:
+        query = Menu.all() if role_id is None else Menu.filter(roles__id=role_id)
+        return await query.order_by("-created_at").values()
+
+    async def invalidate(self):
+        """菜单变更后调用，与变更处于同一事务时各进程在提交后才会看到"""
+        await ChangeLog.create(topic=self.topic, op="invalidate", origin=ORIGIN)
+        self._clear()
+
+    def _clear(self):
+        self.version += 1
+        self._trees.clear()
+        self._bundles.clear()
+
+    async def start(self):
+        """记录当前版本号，并清理过期的变更日志"""
+        await self.log.start()
+        self._clear()
+
+    async def run(self):
+        """后台轮询其他进程的菜单变更"""
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                if await self.log.read():
+                    self._clear()
+            except Exception:
+                logger.exception("同步菜单变更失败")
+
+
+menu_tree_cache = MenuTreeCache()
+
+
+class TokenRevocations:
+    """
+    token 吊销同步：吊销列表保存在各进程内存中，吊销时写入一条 ChangeLog，
+    其他进程轮询后加入本地吊销列表，启动时加载保留期内的吊销记录
+    """
+
+    topic = "token"
+
+    def __init__(self, interval: float = POLICY_SYNC_INTERVAL):
+        self.interval = interval
+        self.log = ChangeLogReader(self.topic)
+
+    async def revoke(self, token: str) -> bool:
+        """
+        吊销token并通知其他进程
+        :param token: token
+        :return: token 校验失败时返回 False
+        """
+        if not (revoked := revoke_token(token)):
+            return False
+        digest, exp = revoked
+        await ChangeLog.create(
+            topic=self.topic,
+            op="revoke",
+            payload={"digest": digest.hex(), "exp": exp},
+            origin=ORIGIN,
         )
-        await Menu.create(
-            name="角色查询",
-            path="",
-            parent=role,
-            component="",
-            permission="role:query",
-            type=MenuType.BUTTON,
-            meta=schemas.MenuMeta(
-                title="角色查询",
-            ).model_dump(),
+        return True
+
+    @staticmethod
+    def _apply(rows: Iterable[ChangeLog]):
+        for row in rows:
+            payload = cast(dict, row.payload)
+            revoke_digest(bytes.fromhex(payload["digest"]), payload["exp"])
+
+    async def start(self):
+        """记录当前版本号并加载已有的吊销记录，变更日志保留期不短于 token 有效期"""
+        await self.log.start()
+        self._apply(await ChangeLog.filter(topic=self.topic, id__lte=self.log.version))
+
+    async def run(self):
+        """后台轮询其他进程的吊销记录"""
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self._apply(await self.log.read())
+            except Exception:
+                logger.exception("同步 token 吊销失败")
+
+
+token_revocations = TokenRevocations()
+
+
+class RouteCatalog:
+    """
+    接口目录：启动时根据路由表生成一次，路由只在部署时变化
+
+    按 (分组, 路径前缀) 缓存序列化后的 JSON 与 ETag，未知路由（如 Mount）没有请求方法，直接跳过
+    """
+
+    def __init__(self, routes: Iterable, cache_size: int = 128):
+        self.routes: tuple[schemas.Route, ...] = tuple(
+            schemas.Route(
+                path=route.path,
+                name=route.name,
+                method=method,
+                summary=getattr(route, "summary", None),
+                tags=getattr(route, "tags", None),
+            )
+            for route in routes
+            for method in sorted(getattr(route, "methods", None) or ())
         )
-        await Menu.create(
-            name="菜单新增",
-            path="",
-            parent=menu,
-            component="",
-            permission="menu:add",
-            type=MenuType.BUTTON,
-            meta=schemas.MenuMeta(
-                title="菜单新增",
-            ).model_dump(),
+        self._keys = frozenset((route.path, route.method) for route in self.routes)
+        self._cache: LRUCache[tuple, tuple[str, bytes]] = LRUCache(cache_size)
+
+    def get(
+        self, tag: str | None = None, prefix: str | None = None
+    ) -> tuple[str, bytes]:
+        """
+        获取接口列表
+        :param tag: 路由分组
+        :param prefix: 路由地址前缀
+        :return: (ETag, 响应内容)
+        """
+        key = (tag, prefix)
+        if (item := self._cache.get(key)) is not None:
+            return item
+        data = [
+            route
+            for route in self.routes
+            if (tag is None or tag in (route.tags or ()))
+            and (prefix is None or route.path.startswith(prefix))
+        ]
+        body = (
+            schemas.PageResult[schemas.Route]
+            .ok(data, total=len(data))
+            .model_dump_json(by_alias=True)
+            .encode()
         )
-        await Menu.create(
-            name="菜单删除",
-            path="",
-            parent=menu,
-            component="",
-            permission="menu:delete",
-            type=MenuType.BUTTON,
-            meta=schemas.MenuMeta(
-                title="菜单删除",
-            ).model_dump(),
+        item = (f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"', body)
+        self._cache.set(key, item)
+        return item
+
+    def __contains__(self, route: tuple[str, str]) -> bool:
+        """(策略路径格式的路由地址, 请求方法) 是否存在"""
+        return route in self._keys
+
+
+# 初始化数据
+INIT_FIXTURE = Path(__file__).parent / "data" / "init.json"
+
+MENU_FIELDS = ("path", "component", "meta", "redirect", "permission", "type")
+
+
+async def load_fixture(path: str | Path = INIT_FIXTURE):
+    """
+    加载初始化数据，菜单按层级批量写入，全部数据在一个事务中完成
+
+    按唯一键存在则更新、不存在则新增，可重复执行：菜单为 (父菜单, 名称)、角色为名称、
+    用户为用户名（已存在的用户不修改密码，相同的初始密码只计算一次哈希）
+    :param path: JSON 文件路径，格式见 apps/system/data/init.json
+    """
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    async with in_transaction():
+        menus = await _load_menus(data.get("menus", []))
+        roles = await _load_roles(data.get("roles", []), menus)
+        await _load_users(data.get("users", []), roles)
+
+
+def _menu_values(node: dict) -> dict:
+    return {
+        "path": node.get("path", ""),
+        "component": node.get("component", ""),
+        "meta": schemas.MenuMeta(**node.get("meta", {})).model_dump(),
+        "redirect": node.get("redirect"),
+        "permission": node.get("permission", ""),
+        "type": MenuType[node.get("type", MenuType.DIRECTORY.name)],
+    }
+
+
+async def _load_menus(tree: list[dict]) -> dict[str, Menu]:
+    """逐层写入菜单，返回 菜单名称路径（如 系统管理/用户管理） -> 菜单"""
+    menus: dict[str, Menu] = {}
+    # (父菜单, 父菜单名称路径, 菜单数据)
+    level: list[tuple[Menu | None, str, dict]] = [(None, "", node) for node in tree]
+    depth = 0
+    while level:
+        names = {node["name"] for _, _, node in level}
+        if depth == 0:
+            query = Q(parent_id__isnull=True)
+        else:
+            query = Q(parent_id__in={parent.id for parent, _, _ in level if parent})
+
+        async def fetch() -> dict[tuple, Menu]:
+            rows = await Menu.filter(query, name__in=names)
+            return {(row.parent_id, row.name): row for row in rows}
+
+        existing = await fetch()
+        created, updated = [], []
+        for parent, _, node in level:
+            values = _menu_values(node)
+            parent_id = parent.id if parent else None
+            if obj := existing.get((parent_id, node["name"])):
+                for field, value in values.items():
+                    setattr(obj, field, value)
+                updated.append(obj)
+            else:
+                tree_path = parent.subtree_path if parent else "/"
+                created.append(
+                    Menu(
+                        name=node["name"],
+                        parent_id=parent_id,
+                        tree_path=tree_path,
+                        depth=depth,
+                        **values,
+                    )
+                )
+        if created:
+            await Menu.bulk_create(created, batch_size=500)
+            existing = await fetch()
+        if updated:
+            await Menu.bulk_update(updated, fields=MENU_FIELDS, batch_size=500)
+
+        next_level: list[tuple[Menu | None, str, dict]] = []
+        for parent, prefix, node in level:
+            obj = existing[(parent.id if parent else None, node["name"])]
+            key = f"{prefix}{node['name']}"
+            menus[key] = obj
+            next_level.extend(
+                (obj, f"{key}/", child) for child in node.get("children", [])
+            )
+        level = next_level
+        depth += 1
+    return menus
+
+
+async def _load_roles(items: list[dict], menus: dict[str, Menu]) -> dict[str, Role]:
+    """写入角色及角色菜单，返回 角色名 -> 角色"""
+    names = [item["name"] for item in items]
+    existing = {role.name: role for role in await Role.filter(name__in=names)}
+    created = [
+        Role(name=item["name"], remark=item.get("remark"))
+        for item in items
+        if item["name"] not in existing
+    ]
+    updated = []
+    for item in items:
+        if (role := existing.get(item["name"])) and "remark" in item:
+            role.remark = item["remark"]
+            updated.append(role)
+    if created:
+        await Role.bulk_create(created, batch_size=500)
+        existing = {role.name: role for role in await Role.filter(name__in=names)}
+    if updated:
+        await Role.bulk_update(updated, fields=["remark"], batch_size=500)
+
+    role_menus = {}
+    for item in items:
+        if "menus" not in item:
+            continue
+        if missing := [key for key in item["menus"] if key not in menus]:
+            raise ValueError(f"菜单不存在: {', '.join(missing)}")
+        role_menus[existing[item["name"]].id] = [menus[key].id for key in item["menus"]]
+    await set_relations(Role, "menus", role_menus)
+    return existing
+
+
+async def _load_users(items: list[dict], roles: dict[str, Role]):
+    """写入用户及用户角色"""
+    fields = ("is_superuser", "is_staff", "avatar")
+    names = [item["username"] for item in items]
+    existing = {user.username: user for user in await User.filter(username__in=names)}
+    hashes: dict[str, str] = {}
+    created, updated = [], []
+    for item in items:
+        values = {field: item[field] for field in fields if field in item}
+        if active_role := item.get("active_role"):
+            values["active_role_id"] = roles[active_role].id
+        if user := existing.get(item["username"]):
+            for field, value in values.items():
+                setattr(user, field, value)
+            updated.append(user)
+        else:
+            password = item.get("password", "123456")
+            if password not in hashes:
+                hashes[password] = get_password_hash(password)
+            created.append(
+                User(username=item["username"], password=hashes[password], **values)
+            )
+    if created:
+        await User.bulk_create(created, batch_size=500)
+        existing = {
+            user.username: user for user in await User.filter(username__in=names)
+        }
+    if updated:
+        await User.bulk_update(
+            updated, fields=[*fields, "active_role_id"], batch_size=500
         )
-        await Menu.create(
-            name="菜单修改",
-            path="",
-            parent=menu,
-            component="",
-            permission="menu:edit",
-            type=MenuType.BUTTON,
-            meta=schemas.MenuMeta(
-                title="菜单修改",
-            ).model_dump(),
+
+    await set_relations(
+        User,
+        "roles",
+        {
+            existing[item["username"]].id: [roles[name].id for name in item["roles"]]
+            for item in items
+            if "roles" in item
+        },
+    )
+
+
+async def set_relations(
+    model: type[Model], field: str, relations: dict[int, list[int]]
+):
+    """
+    批量替换多对多关系：一条 DELETE 删除旧关系，再按批 INSERT 新关系
+    :param model: 模型
+    :param field: 多对多字段名
+    :param relations: 主键 -> 关联对象主键列表
+    """
+    if not relations:
+        return
+    m2m = cast(ManyToManyFieldInstance, model._meta.fields_map[field])
+    db = model._meta.db
+    table = Table(m2m.through)
+    await db.execute_query(
+        str(
+            db.query_class.from_(table)
+            .where(table[m2m.backward_key].isin(list(relations)))
+            .delete()
         )
-        await Menu.create(
-            name="菜单查询",
-            path="",
-            parent=menu,
-            component="",
-            permission="menu:query",
-            type=MenuType.BUTTON,
-            meta=schemas.MenuMeta(
-                title="菜单查询",
-            ).model_dump(),
+    )
+    rows = [
+        (pk, related)
+        for pk, related_pks in relations.items()
+        for related in dict.fromkeys(related_pks)
+    ]
+    for i in range(0, len(rows), 500):
+        await db.execute_query(
+            str(
+                db.query_class.into(table)
+                .columns(m2m.backward_key, m2m.forward_key)
+                .insert(*rows[i : i + 500])
+            )
         )
+
+
+async def backfill_menu_paths():
+    """
+    补全升级前已有菜单的 tree_path、depth：新增列默认值使所有菜单都是根菜单，
+    存在有父菜单但 depth 为 0 的菜单时，从根菜单开始按 parent_id 逐层计算，每层一次批量更新
+    """
+    if not await Menu.filter(parent_id__isnull=False, depth=0).exists():
+        return
+    async with in_transaction():
+        level = await Menu.filter(parent_id__isnull=True)
+        for menu in level:
+            menu.tree_path, menu.depth = "/", 0
+        while level:
+            await Menu.bulk_update(level, fields=["tree_path", "depth"], batch_size=500)
+            parents = {menu.id: menu for menu in level}
+            level = await Menu.filter(parent_id__in=list(parents))
+            for menu in level:
+                menu.tree_path = parents[menu.parent_id].subtree_path
+                menu.depth = menu.tree_path.count("/") - 1
+
+
+async def init_db():
+    await backfill_menu_paths()
+    if not await User.filter(username="admin").exists():
+        await load_fixture()
@@ -0,0 +1,209 @@
+"""多进程策略同步"""
+
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import TYPE_CHECKING, cast
+
+from tortoise.expressions import Q
+
+from apps.system.models import ChangeLog
+from core.settings import (
+    POLICY_SYNC_GAP_TIMEOUT,
+    POLICY_SYNC_INTERVAL,
+    POLICY_SYNC_PRUNE_INTERVAL,
+    POLICY_SYNC_RETENTION_DAYS,
+)
+
+if TYPE_CHECKING:
+    from apps.system.enforcer import Enforcer
+
+logger = logging.getLogger(__name__)
+
+# 当前进程标识，用于跳过本进程写入的变更
+ORIGIN = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class ChangeLogReader:
+    """
+    按主题增量读取变更日志
+
+    PostgreSQL、MySQL 上自增ID按分配顺序而非提交顺序可见，持有较小ID的事务可能晚于较大ID提交，
+    因此读取时记录小于已读版本但尚未出现的ID（空洞），之后继续查询这些ID，
+    超过 gap_timeout 秒仍未出现的视为已回滚
+    """
+
+    def __init__(
+        self,
+        topic: str,
+        gap_timeout: float = POLICY_SYNC_GAP_TIMEOUT,
+        skip_own: bool = True,
+    ):
+        self.topic = topic
+        self.gap_timeout = gap_timeout
+        self.skip_own = skip_own
+        # 已读取的最大变更日志ID
+        self.version = 0
+        # 尚未出现的变更日志ID -> 发现时间
+        self.gaps: dict[int, float] = {}
+        # 上次清理过期变更日志的时间
+        self.pruned_at = time.monotonic()
+
+    async def start(self):
+        """记录当前版本号，并清理过期的变更日志"""
+        # 使用所有主题的最大ID，否则首次读取会把其他主题的历史日志全部查出
+        self.version = (
+            await ChangeLog.all().order_by("-id").first().values_list("id", flat=True)
+        ) or 0
+        self.gaps.clear()
+        await self.prune()
+
+    async def prune(self):
+        """清理本主题超过保留天数的变更日志"""
+        self.pruned_at = time.monotonic()
+        await ChangeLog.filter(
+            topic=self.topic,
+            created_at__lt=datetime.now() - timedelta(days=POLICY_SYNC_RETENTION_DAYS),
+        ).delete()
+
+    async def read(self) -> list[ChangeLog]:
+        """
+        读取新的变更，包括之前空洞中晚提交的变更，skip_own 时跳过本进程写入的；
+        每隔 POLICY_SYNC_PRUNE_INTERVAL 秒清理一次过期的变更日志
+        """
+        now = time.monotonic()
+        if now - self.pruned_at >= POLICY_SYNC_PRUNE_INTERVAL:
+            await self.prune()
+        self.gaps = {
+            id: seen for id, seen in self.gaps.items() if now - seen < self.gap_timeout
+        }
+        query = Q(id__gt=self.version)
+        if self.gaps:
+            query |= Q(id__in=list(self.gaps))
+        # 不按主题过滤，其他主题的ID不会被当作空洞
+        rows = await ChangeLog.filter(query).order_by("id")
+        for row in rows:
+            if row.id > self.version:
+                self.gaps.update(dict.fromkeys(range(self.version + 1, row.id), now))
+                self.version = row.id
+            else:
+                self.gaps.pop(row.id, None)
+        return [
+            row
+            for row in rows
+            if row.topic == self.topic and not (self.skip_own and row.origin == ORIGIN)
+        ]
+
+
+class PolicyWatcher:
+    """
+    基于 ChangeLog 表的 casbin watcher
+
+    本进程的策略变更由 casbin 回调写入 ChangeLog（与策略写入处于同一事务），
+    其他进程通过 ChangeLogReader 轮询，只把增量应用到内存模型，避免全量 load_policy 阻塞事件循环
+    """
+
+    topic = "policy"
+
+    def __init__(
+        self,
+        enforcer: "Enforcer",
+        interval: float = POLICY_SYNC_INTERVAL,
+        gap_timeout: float = POLICY_SYNC_GAP_TIMEOUT,
+    ):
+        self.enforcer = enforcer
+        self.interval = interval
+        self.log = ChangeLogReader(self.topic, gap_timeout)
+        # casbin 同步调用 update 后待写入的 reload
+        self.pending_reload = False
+
+    async def start(self):
+        """记录当前版本号，需在 load_policy 之前调用，之后的变更会重复应用（幂等）"""
+        await self.log.start()
+
+    async def run(self):
+        """后台轮询变更日志"""
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                # 正常情况下 reload 已由 Enforcer 在变更所在的上下文中写入
+                await self.flush()
+                await self.poll()
+            except Exception:
+                logger.exception("同步策略变更失败")
+
+    async def poll(self):
+        """拉取并应用其他进程的策略变更"""
+        for row in await self.log.read():
+            await self._apply(row)
+
+    async def _apply(self, row: ChangeLog):
+        # 策略变更的 payload 都是对象
+        payload = cast(dict, row.payload or {})
+        if row.op == "reload":
+            await self.enforcer.load_policy()
+        elif row.op == "remove_filtered":
+            self.enforcer.apply_change(
+                row.op,
+                payload["sec"],
+                payload["ptype"],
+                field_index=payload["field_index"],
+                field_values=payload["field_values"],
+            )
+        else:
+            self.enforcer.apply_change(
+                row.op, payload["sec"], payload["ptype"], rules=payload["rules"]
+            )
+
+    async def _record(self, op: str, **payload):
+        await ChangeLog.create(topic=self.topic, op=op, payload=payload, origin=ORIGIN)
+
+    # casbin watcher 接口
+    def set_update_callback(self, func):
+        pass
+
+    def update(self):
+        """
+        casbin 对 update_policy 等变更只同步调用 update，此时通知其他进程全量重新加载；
+        这里无法等待写入，只做标记，由 Enforcer 在变更返回后于调用方的事务中调用 flush 写入
+        """
+        self.pending_reload = True
+
+    async def flush(self):
+        """写入待通知的 reload"""
+        if self.pending_reload:
+            self.pending_reload = False
+            await self._record("reload")
+
+    async def update_for_save_policy(self, model):
+        await self._record("reload")
+
+    async def update_for_add_policy(self, sec: str, ptype: str, rule: list[str]):
+        await self._record("add", sec=sec, ptype=ptype, rules=[rule])
+
+    async def update_for_add_policies(self, sec: str, ptype: str, rules: list):
+        await self._record("add", sec=sec, ptype=ptype, rules=list(rules))
+
+    async def update_for_remove_policy(self, sec: str, ptype: str, rule: list[str]):
+        await self._record("remove", sec=sec, ptype=ptype, rules=[rule])
+
+    async def update_for_remove_policies(self, sec: str, ptype: str, rules: list):
+        await self._record("remove", sec=sec, ptype=ptype, rules=list(rules))
+
+    async def update_for_remove_filtered_policy(
+        self, sec: str, ptype: str, field_index: int, *field_values: str
+    ):
+        await self._record(
+            "remove_filtered",
+            sec=sec,
+            ptype=ptype,
+            field_index=field_index,
+            field_values=list(field_values),
+        )
+
+    def close(self):
+        pass
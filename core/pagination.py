@@ -0,0 +1,154 @@
+import base64
+import json
+from typing import Any, AsyncIterator, Collection, Sequence
+
+from tortoise.expressions import Q
+from tortoise.models import Model
+from tortoise.queryset import QuerySet
+
+from core.cache import TTLCache
+from core.schemas import CountMode
+from core.settings import COUNT_CACHE_SIZE, COUNT_CACHE_TTL
+
+# (模型, 查询条件) -> 总数
+count_cache: TTLCache[tuple, int] = TTLCache(COUNT_CACHE_SIZE, COUNT_CACHE_TTL)
+
+
+def encode_cursor(value: Any, pk: Any) -> str:
+    """
+    生成游标
+    :param value: 最后一条数据的排序字段值
+    :param pk: 最后一条数据的主键
+    """
+    raw = json.dumps([value, pk], default=str, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple[Any, Any]:
+    """
+    解析游标
+    :param cursor: encode_cursor 生成的游标
+    :raises ValueError: 游标格式错误
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        value, pk = json.loads(raw)
+    except Exception as e:
+        raise ValueError("无效的游标") from e
+    return value, pk
+
+
+def _get(row: Model | dict, field: str) -> Any:
+    return row[field] if isinstance(row, dict) else getattr(row, field)
+
+
+async def keyset_paginate(
+    queryset: QuerySet,
+    order_by: str,
+    cursor: str | None,
+    size: int,
+    fields: list[str] | None = None,
+    unsortable: Collection[str] = (),
+) -> tuple[list, str | None]:
+    """
+    游标分页：按 (排序字段, 主键) 定位下一页，任意页码的查询代价相同
+    :param queryset: 已加好过滤条件的查询
+    :param order_by: 排序字段，-前缀为倒序，默认按主键
+    :param cursor: 上一页返回的游标，为空时查询第一页
+    :param size: 每页数量
+    :param fields: 只查询的字段，排序字段和主键用于生成游标，未指定时不返回
+    :param unsortable: 不允许排序的字段，游标中带有排序字段的明文值
+    :return: (数据, 下一页游标，没有下一页时为 None)
+    """
+    desc = order_by.startswith("-")
+    field = order_by.lstrip("-") or "id"
+    if field in unsortable or field not in queryset.model._meta.fields_db_projection:
+        raise ValueError("游标分页不支持该排序字段")
+    op = "lt" if desc else "gt"
+    if cursor:
+        value, pk = decode_cursor(cursor)
+        if field == "id":
+            queryset = queryset.filter(**{f"id__{op}": pk})
+        else:
+            queryset = queryset.filter(
+                Q(**{f"{field}__{op}": value}) | Q(**{field: value, f"id__{op}": pk})
+            )
+    direction = "-" if desc else ""
+    orderings = [f"{direction}id"] if field == "id" else [order_by, f"{direction}id"]
+    queryset = queryset.order_by(*orderings).limit(size + 1)
+    if fields:
+        rows = await queryset.values(*dict.fromkeys([*fields, field, "id"]))
+    else:
+        rows = await queryset
+    next_cursor = None
+    if len(rows) > size:
+        rows = rows[:size]
+        next_cursor = encode_cursor(_get(rows[-1], field), _get(rows[-1], "id"))
+    if fields and (extra := {field, "id"}.difference(fields)):
+        rows = [{k: v for k, v in row.items() if k not in extra} for row in rows]
+    return list(rows), next_cursor
+
+
+async def keyset_batches(
+    queryset: QuerySet, size: int, *fields: str, **aliases: str
+) -> AsyncIterator[list[dict]]:
+    """
+    按主键分批遍历查询结果，每批都是 id > 上一批最大 id 的索引范围查询，
+    遍历任意多的数据内存占用都只有一批
+    :param queryset: 已加好过滤条件的查询
+    :param size: 每批数量
+    :param fields: 查询的字段，会补充主键
+    :param aliases: 别名 -> 字段，如 active_role="active_role__name"
+    """
+    last = None
+    while True:
+        batch = queryset if last is None else queryset.filter(id__gt=last)
+        rows = (
+            await batch.order_by("id")
+            .limit(size)
+            .values(*dict.fromkeys(["id", *fields]), **aliases)
+        )
+        if rows:
+            yield rows
+        if len(rows) < size:
+            return
+        last = rows[-1]["id"]
+
+
+async def fetch_by_ids(
+    queryset: QuerySet, ids: list[int], fields: Sequence[str] | None = None
+) -> tuple[list, list[int]]:
+    """
+    按ID批量查询，只执行一次 id__in 查询
+    :param queryset: 查询
+    :param ids: ID列表，重复的ID只返回一次
+    :param fields: 只查询的字段，会补充主键
+    :return: (按 ids 顺序排列的数据, 不存在的ID)
+    """
+    ids = list(dict.fromkeys(ids))
+    queryset = queryset.filter(id__in=ids)
+    if fields:
+        rows = await queryset.values(*dict.fromkeys(["id", *fields]))
+    else:
+        rows = await queryset
+    found = {_get(row, "id"): row for row in rows}
+    return [found[i] for i in ids if i in found], [i for i in ids if i not in found]
+
+
+async def count_total(
+    model: type[Model], filters: dict, mode: CountMode = CountMode.EXACT
+) -> int | None:
+    """
+    统计总数
+    :param model: 模型
+    :param filters: 查询条件
+    :param mode: exact 精确统计、cached 使用 COUNT_CACHE_TTL 秒内的缓存、none 不统计
+    """
+    if mode == CountMode.NONE:
+        return None
+    key = (model, tuple(sorted(filters.items())))
+    if mode == CountMode.CACHED and (cached := count_cache.get(key)) is not None:
+        return cached
+    total = await model.filter(**filters).count()
+    count_cache.set(key, total)
+    return total
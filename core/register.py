@@ -1,17 +1,36 @@
+import asyncio
 import contextlib
+import fcntl
+import hashlib
 import importlib
-import inspect
+import json
 from pathlib import Path
+from typing import AsyncIterator, Iterable, NamedTuple, cast
 
 from fastapi import FastAPI
 from fastapi.routing import APIRouter
+from starlette.concurrency import run_in_threadpool
 from starlette.middleware import Middleware
 from starlette.middleware.cors import CORSMiddleware
+from pypika import Table
+from tortoise import Tortoise
+from tortoise.backends.base.client import BaseDBAsyncClient
 from tortoise.contrib.fastapi import RegisterTortoise
 from tortoise.models import Model
+from tortoise.transactions import in_transaction
+from tortoise.utils import get_schema_sql
 
 from apps import system
-from core.settings import DB_URL
+from core import security
+from core.settings import (
+    APP_PACKAGES,
+    BASE_DIR,
+    DB_URL,
+    DISCOVERY_MANIFEST,
+    SCHEMA_COLUMNS,
+    SCHEMA_CREATE_INDEXES,
+    SCHEMA_INDEXES,
+)
 
 
 def find_python_files(directory: Path):
@@ -20,80 +39,322 @@ def find_python_files(directory: Path):
 
     :param directory: 要搜索的目录
     """
-    for file in directory.iterdir():
+    for file in sorted(directory.iterdir()):
         if file.is_dir():
             yield from find_python_files(file)
         elif file.suffix == ".py" and file.name != "__init__.py":
             yield file
 
 
-def register_routers(app: FastAPI, root_dir: str = "."):
+class Discovery(NamedTuple):
+    """模块发现结果"""
+
+    # 路由，格式为 模块名:变量名
+    routers: list[str]
+    # 包含模型的模块名
+    models: list[str]
+
+
+def _watched_paths(root_path: Path, packages: Iterable[str]) -> list[Path]:
+    """需要监控修改时间的目录和文件，目录的修改时间在增删文件时变化"""
+    paths = []
+    for package in packages:
+        directory = root_path.joinpath(*package.split("."))
+        paths.append(directory)
+        paths.extend(
+            path
+            for path in directory.rglob("*")
+            if "__pycache__" not in path.parts
+            and (path.suffix == ".py" or path.is_dir())
+        )
+    return paths
+
+
+def _mtimes(paths: Iterable[Path]) -> dict[str, int] | None:
+    try:
+        return {str(path): path.stat().st_mtime_ns for path in paths}
+    except OSError:
+        return None
+
+
+def _load_manifest(manifest: str, packages: list[str]) -> Discovery | None:
+    """读取缓存的发现结果，应用包或任一文件的修改时间变化时失效，
+    未标记 complete 的清单（旧版本在模块导入失败时写入的）同样失效"""
+    try:
+        with open(manifest, encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if data.get("packages") != packages or not data.get("complete"):
+        return None
+    if _mtimes(map(Path, data.get("mtimes", {}))) != data.get("mtimes"):
+        return None
+    return Discovery(data["routers"], data["models"])
+
+
+def _resolvable(discovery: Discovery) -> bool:
+    """缓存中的模块和路由仍能导入，环境变化（如缺少依赖）后不再沿用旧清单"""
+    try:
+        for path in discovery.routers:
+            module_name, name = path.split(":")
+            getattr(importlib.import_module(module_name), name)
+        for module_name in discovery.models:
+            importlib.import_module(module_name)
+    except (ImportError, AttributeError, ValueError):
+        return False
+    return True
+
+
+def _scan(root_path: Path, packages: list[str]) -> tuple[Discovery, bool]:
+    """扫描应用包，返回发现结果以及是否所有模块都导入成功"""
+    routers: list[str] = []
+    models: list[str] = []
+    seen: set[int] = set()
+    complete = True
+    directories = [root_path.joinpath(*package.split(".")) for package in packages]
+    for directory in directories or [root_path]:
+        for python_file in find_python_files(directory):
+            relative_path = python_file.relative_to(root_path)
+            module_name = relative_path.with_suffix("").as_posix().replace("/", ".")
+
+            try:
+                module = importlib.import_module(module_name)
+            except Exception as e:
+                print(f"无法导入模块 {module_name}: {e}")
+                complete = False
+                continue
+            has_model = False
+            for name, obj in vars(module).items():
+                # 同一个路由对象被其他模块导入时只注册一次
+                if isinstance(obj, APIRouter) and id(obj) not in seen:
+                    seen.add(id(obj))
+                    routers.append(f"{module_name}:{name}")
+                elif (
+                    isinstance(obj, type)
+                    and issubclass(obj, Model)
+                    and not cast(type[Model], obj)._meta.abstract
+                    and obj.__module__ == module_name
+                ):
+                    has_model = True
+            if has_model:
+                models.append(module_name)
+    return Discovery(routers, models), complete
+
+
+def discover(
+    root_dir: str = BASE_DIR,
+    packages: Iterable[str] = APP_PACKAGES,
+    manifest: str | None = DISCOVERY_MANIFEST,
+) -> Discovery:
     """
-    动态获取当前项目下所有的路由（BaseRoute 实例），支持嵌套目录。
+    一次扫描同时发现路由和模型，结果按文件修改时间缓存到清单文件，
+    清单有效时只导入包含路由的模块，不再遍历目录、导入所有文件；
+    有模块导入失败时不写清单，清单中的路由无法导入时重新扫描
 
-    :param app: FastAPI 应用实例
     :param root_dir: 项目根目录路径
+    :param packages: 应用包，为空时扫描整个项目
+    :param manifest: 清单文件路径，为空时不缓存
     """
     root_path = Path(root_dir).resolve()
+    packages = list(packages)
+    cached = _load_manifest(manifest, packages) if manifest else None
+    if cached and _resolvable(cached):
+        return cached
 
-    for python_file in find_python_files(root_path):
-        relative_path = python_file.relative_to(root_path)
-        module_name = relative_path.with_suffix("").as_posix().replace("/", ".")
+    found, complete = _scan(root_path, packages)
+    if manifest and packages and complete:
+        mtimes = _mtimes(_watched_paths(root_path, packages))
+        with contextlib.suppress(OSError):
+            with open(manifest, "w", encoding="utf-8") as f:
+                json.dump(
+                    {
+                        "packages": packages,
+                        "mtimes": mtimes,
+                        "complete": True,
+                        **found._asdict(),
+                    },
+                    f,
+                )
+    return found
 
-        try:
-            module = importlib.import_module(module_name)
-            routers = [
-                obj
-                for _, obj in inspect.getmembers(module)
-                if isinstance(obj, APIRouter)
-            ]
-            for router in routers:
-                app.include_router(router)
-        except Exception as e:
-            print(f"无法导入模块 {module_name}: {e}")
-
-
-def find_models(root_dir: str = "."):
+
+def register_routers(app: FastAPI, discovery: Discovery):
     """
-    动态获取当前项目下所有的模型类（TortoiseORM），支持嵌套目录。
+    注册发现的路由
 
-    :param root_dir: 项目根目录路径
+    :param app: FastAPI 应用实例
+    :param discovery: 模块发现结果
     """
-    models_str = set()
-    root_path = Path(root_dir).resolve()
+    for path in discovery.routers:
+        module_name, name = path.split(":")
+        app.include_router(getattr(importlib.import_module(module_name), name))
+
 
-    for python_file in find_python_files(root_path):
-        relative_path = python_file.relative_to(root_path)
-        module_name = relative_path.with_suffix("").as_posix().replace("/", ".")
+def _index_sql(quote: str) -> list[str]:
+    return [
+        f"CREATE INDEX IF NOT EXISTS {quote}idx_{table}_{'_'.join(columns)}{quote} "
+        f"ON {quote}{table}{quote} ({', '.join(quote + c + quote for c in columns)})"
+        for table, columns in SCHEMA_INDEXES
+    ]
 
+
+async def _table_columns(conn: BaseDBAsyncClient, table: str) -> set[str]:
+    dialect = conn.capabilities.dialect
+    if dialect == "sqlite":
+        rows = await conn.execute_query_dict(f"PRAGMA table_info('{table}')")
+    else:
+        schema = "current_schema()" if dialect == "postgres" else "DATABASE()"
+        rows = await conn.execute_query_dict(
+            "SELECT column_name AS name FROM information_schema.columns "
+            f"WHERE table_schema = {schema} AND table_name = '{table}'"
+        )
+    return {row["name"] for row in rows}
+
+
+async def _add_columns(conn: BaseDBAsyncClient, quote: str):
+    """
+    generate_schemas 不会修改已有的表，在其之前为旧表补充 SCHEMA_COLUMNS 中缺少的字段，
+    否则 SQLite 会把索引中不存在的列名当作字符串常量建出错误的索引
+    """
+    for table, column, definition in SCHEMA_COLUMNS:
+        columns = await _table_columns(conn, table)
+        if not columns or column in columns:
+            continue
+        await conn.execute_script(
+            f"ALTER TABLE {quote}{table}{quote} "
+            f"ADD COLUMN {quote}{column}{quote} {definition}"
+        )
+        if conn.capabilities.dialect == "sqlite":
+            # 重建之前按字符串常量建出的索引
+            await conn.execute_script(f"REINDEX {quote}{table}{quote}")
+
+
+async def _read_fingerprint(conn: BaseDBAsyncClient, table: Table) -> str | None:
+    try:
+        rows = await conn.execute_query_dict(
+            str(conn.query_class.from_(table).select("fingerprint"))
+        )
+    except Exception:
+        return None
+    return rows[0]["fingerprint"] if rows else None
+
+
+@contextlib.asynccontextmanager
+async def _lock_schema(conn: BaseDBAsyncClient) -> AsyncIterator[BaseDBAsyncClient]:
+    """
+    加排他锁，多个进程同时启动时只有一个执行建表，返回执行建表使用的连接：
+    SQLite 的 executescript 会先提交当前事务，事务中的锁覆盖不到建表语句，改用数据库文件旁的文件锁；
+    PostgreSQL 在事务中使用事务级 advisory lock，MySQL 使用 GET_LOCK
+    """
+    dialect = conn.capabilities.dialect
+    if dialect == "sqlite":
+        path = getattr(conn, "filename", ":memory:")
+        if path == ":memory:":
+            yield conn
+            return
+        with open(f"{path}.lock", "a") as f:
+            await run_in_threadpool(fcntl.flock, f, fcntl.LOCK_EX)
+            yield conn
+        return
+    async with in_transaction("default") as tx:
+        if dialect == "postgres":
+            await tx.execute_query("SELECT pg_advisory_xact_lock(hashtext('schema'))")
+        elif dialect == "mysql":
+            await tx.execute_query("SELECT GET_LOCK('schema', 300)")
         try:
-            module = importlib.import_module(module_name)
-            for _, obj in inspect.getmembers(module):
-                if issubclass(obj, Model):
-                    if obj._meta.abstract:
-                        continue
-                    models_str.add(module_name)
-        except Exception as e:
-            print(f"无法导入模块 {module_name}: {e}")
-    return models_str
+            yield tx
+        finally:
+            if dialect == "mysql":
+                await tx.execute_query("SELECT RELEASE_LOCK('schema')")
+
+
+async def ensure_schema(create_indexes: bool = SCHEMA_CREATE_INDEXES):
+    """
+    按模型生成的建表语句计算指纹并保存在 schema_fingerprint 表中，
+    指纹不变时只需一次查询，模型变化时才执行建表并为旧表补充 SCHEMA_COLUMNS 中的字段，
+    避免每个进程启动都执行 DDL；建表前加锁并重新比较指纹，多个进程同时启动时其他进程等待后直接跳过
+
+    :param create_indexes: 是否创建 SCHEMA_INDEXES 中的索引
+    """
+    conn = Tortoise.get_connection("default")
+    quote = conn.query_class._builder().QUOTE_CHAR or ""
+    statements = [get_schema_sql(conn, safe=True)]
+    if create_indexes:
+        statements.extend(_index_sql(quote))
+    fingerprint = hashlib.sha256("\n".join(statements).encode()).hexdigest()
+
+    table = Table("schema_fingerprint")
+    if await _read_fingerprint(conn, table) == fingerprint:
+        return
+
+    async with _lock_schema(conn) as db:
+        # 持有锁后再建指纹表，首次启动时读取指纹不会因表不存在而中止 PostgreSQL 的事务
+        await db.execute_script(
+            f"CREATE TABLE IF NOT EXISTS {quote}schema_fingerprint{quote} "
+            f"({quote}fingerprint{quote} VARCHAR(64) NOT NULL)"
+        )
+        if await _read_fingerprint(db, table) == fingerprint:
+            return
+        await _add_columns(db, quote)
+        await Tortoise.generate_schemas(safe=True)
+        for sql in statements[1:]:
+            await db.execute_script(sql)
+        async with in_transaction("default") as tx:
+            await tx.execute_query(str(tx.query_class.from_(table).delete()))
+            await tx.execute_query(str(tx.query_class.into(table).insert(fingerprint)))
 
 
 @contextlib.asynccontextmanager
 async def lifespan(app: FastAPI):
-    register_routers(app)
+    discovery = discover()
+    register_routers(app, discovery)
     async with RegisterTortoise(
         app,
         db_url=DB_URL,
-        modules={"models": ["casbin_tortoise_adapter", *find_models()]},
-        generate_schemas=True,
+        modules={"models": ["casbin_tortoise_adapter", *discovery.models]},
+        generate_schemas=False,
         add_exception_handlers=True,
     ):
-        e = await system.init_casbin()
+        await ensure_schema()
+        e = await system.init_casbin(app.routes)
         app.state.enforcer = e
-        from apps.system.utils import init_db
+        from apps.system.deps import principal_invalidations
+        from apps.system.storage import run_upload_cleanup
+        from apps.system.utils import (
+            RouteCatalog,
+            init_db,
+            last_login_buffer,
+            menu_tree_cache,
+            token_revocations,
+        )
 
+        app.state.route_catalog = RouteCatalog(app.routes)
+
+        await menu_tree_cache.start()
+        await token_revocations.start()
+        await principal_invalidations.start()
         await init_db()
-        yield
+        # 后台任务：同步其他进程的策略变更、批量写入登录时间、同步菜单变更、
+        # 同步 token 吊销、同步用户身份缓存失效、清理过期的上传会话
+        tasks = [
+            asyncio.create_task(e.watcher.run()),
+            asyncio.create_task(last_login_buffer.run()),
+            asyncio.create_task(menu_tree_cache.run()),
+            asyncio.create_task(token_revocations.run()),
+            asyncio.create_task(principal_invalidations.run()),
+            asyncio.create_task(run_upload_cleanup()),
+        ]
+        try:
+            yield
+        finally:
+            for task in tasks:
+                task.cancel()
+            for task in tasks:
+                with contextlib.suppress(asyncio.CancelledError):
+                    await task
+            await last_login_buffer.flush()
+            security.password_hasher.shutdown()
+            security.bulk_password_hasher.shutdown()
 
 
 middleware = [
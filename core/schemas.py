@@ -1,4 +1,5 @@
 from datetime import datetime
+from enum import StrEnum
 from typing import Generic, TypeVar
 
 from pydantic import BaseModel, Field
@@ -23,13 +24,47 @@ class Result(BaseModel, Generic[T]):
 
 
 class PageResult(Result[T]):
-    total: int = Field(0, description="数据总数")
+    model_config = {"populate_by_name": True}
+
+    total: int | None = Field(0, description="数据总数，不统计时为空")
+    data: list[T] | None = Field(default_factory=list, description="响应数据")  # type: ignore
+    next_cursor: str | None = Field(
+        None, alias="nextCursor", description="下一页游标，游标分页时返回"
+    )
+
+    @classmethod
+    @override
+    def ok(  # type: ignore
+        cls,
+        data: list[T] | None = None,
+        message: str = "成功",
+        total: int | None = 0,
+        next_cursor: str | None = None,
+    ):
+        return cls(
+            data=data or [],
+            total=total,
+            message=message,
+            success=True,
+            nextCursor=next_cursor,
+        )
+
+
+class BatchResult(Result[T]):
     data: list[T] | None = Field(default_factory=list, description="响应数据")  # type: ignore
+    missing: list[int] = Field(default_factory=list, description="不存在的ID")
 
     @classmethod
     @override
-    def ok(cls, data: list[T] | None = None, message: str = "成功", total: int = 0):  # type: ignore
-        return cls(data=data or [], total=total, message=message, success=True)
+    def ok(  # type: ignore
+        cls,
+        data: list[T] | None = None,
+        message: str = "成功",
+        missing: list[int] | None = None,
+    ):
+        return cls(
+            data=data or [], missing=missing or [], message=message, success=True
+        )
 
 
 class RequestSchema(BaseModel):
@@ -51,6 +86,14 @@ class ResponseSchema(BaseModel):
     }
 
 
+class CountMode(StrEnum):
+    """总数统计方式"""
+
+    EXACT = "exact"
+    CACHED = "cached"
+    NONE = "none"
+
+
 class PageParams(RequestSchema):
     """分页参数"""
 
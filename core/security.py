@@ -1,12 +1,37 @@
+import asyncio
+import hashlib
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Callable, Optional, TypeVar
 
+from fastapi import HTTPException
 from jose import jwt
+from jose.exceptions import ExpiredSignatureError, JWTError
 from passlib.context import CryptContext
 
-from core.settings import ACCESS_TOKEN_EXPIRE_MINUTES, ALGORITHM, SECRET_KEY
+from core.cache import LRUCache
+from core.settings import (
+    ACCESS_TOKEN_EXPIRE_MINUTES,
+    ALGORITHM,
+    BCRYPT_ROUNDS,
+    BULK_HASH_WORKERS,
+    PASSWORD_HASH_EXECUTOR,
+    PASSWORD_HASH_QUEUE_SIZE,
+    PASSWORD_HASH_WORKERS,
+    SECRET_KEY,
+    TOKEN_CACHE_SIZE,
+)
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+R = TypeVar("R")
+
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS,
+    bcrypt__max_rounds=BCRYPT_ROUNDS,
+)
 
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
@@ -19,6 +44,18 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
 
 
+def verify_and_update_password(
+    plain_password: str, hashed_password: str
+) -> tuple[bool, str | None]:
+    """
+    验证密码，hash 的成本因子与当前配置不一致时返回新的 hash
+    :param plain_password: 明文密码
+    :param hashed_password: hash密码
+    :return: (是否通过, 新的hash密码或None)
+    """
+    return pwd_context.verify_and_update(plain_password, hashed_password)
+
+
 def get_password_hash(password: str) -> str:
     """
     加密明文
@@ -28,9 +65,106 @@ def get_password_hash(password: str) -> str:
     return pwd_context.hash(password)
 
 
-def generate_token(username: str, expires_delta: Optional[timedelta] = None):
-    """生成token"""
-    to_encode = {"sub": username}.copy()
+class PasswordHasher:
+    """
+    在线程池/进程池中执行 bcrypt 计算，避免阻塞事件循环
+
+    同时执行的任务数不超过 workers，排队任务数超过 queue_size 时直接返回 503
+    """
+
+    def __init__(
+        self,
+        executor: str = PASSWORD_HASH_EXECUTOR,
+        workers: int = PASSWORD_HASH_WORKERS,
+        queue_size: int = PASSWORD_HASH_QUEUE_SIZE,
+    ):
+        self.executor_type = executor
+        self.workers = workers
+        self.queue_size = queue_size
+        self._executor: Executor | None = None
+        self._semaphore: asyncio.Semaphore | None = None
+        self._pending = 0
+
+    @property
+    def executor(self) -> Executor:
+        if self._executor is None:
+            if self.executor_type == "process":
+                self._executor = ProcessPoolExecutor(self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(
+                    self.workers, thread_name_prefix="password-hasher"
+                )
+        return self._executor
+
+    async def run(self, func: Callable[..., R], *args) -> R:
+        if self._pending >= self.workers + self.queue_size:
+            raise HTTPException(503, "服务繁忙，请稍后重试")
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.workers)
+        self._pending += 1
+        try:
+            async with self._semaphore:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(self.executor, func, *args)
+        finally:
+            self._pending -= 1
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        self._semaphore = None
+
+
+password_hasher = PasswordHasher()
+# 批量导入用户使用的进程池，与登录使用的 password_hasher 隔离
+bulk_password_hasher = PasswordHasher("process", BULK_HASH_WORKERS, BULK_HASH_WORKERS)
+
+
+async def async_verify_and_update_password(
+    plain_password: str, hashed_password: str
+) -> tuple[bool, str | None]:
+    """verify_and_update_password 的异步版本，在 password_hasher 中执行"""
+    return await password_hasher.run(
+        verify_and_update_password, plain_password, hashed_password
+    )
+
+
+async def async_get_password_hash(password: str) -> str:
+    """get_password_hash 的异步版本，在 password_hasher 中执行"""
+    return await password_hasher.run(get_password_hash, password)
+
+
+def get_password_hashes(passwords: list[str]) -> list[str]:
+    return [get_password_hash(password) for password in passwords]
+
+
+async def async_get_password_hashes(passwords: list[str]) -> list[str]:
+    """批量计算密码哈希，按进程数拆分后在 bulk_password_hasher 中并行执行"""
+    if not passwords:
+        return []
+    size = -(-len(passwords) // bulk_password_hasher.workers)
+    chunks = await asyncio.gather(
+        *(
+            bulk_password_hasher.run(get_password_hashes, passwords[i : i + size])
+            for i in range(0, len(passwords), size)
+        )
+    )
+    return [hashed for chunk in chunks for hashed in chunk]
+
+
+def generate_token(
+    username: str,
+    expires_delta: Optional[timedelta] = None,
+    claims: Optional[dict] = None,
+):
+    """
+    生成token
+    :param username: 用户名
+    :param expires_delta: 有效期，默认 ACCESS_TOKEN_EXPIRE_MINUTES
+    :param claims: 额外写入的 claims
+    """
+    to_encode = {"sub": username, **(claims or {})}
     if expires_delta:
         expire = datetime.utcnow() + expires_delta
     else:
@@ -38,3 +172,65 @@ def generate_token(username: str, expires_delta: Optional[timedelta] = None):
     to_encode.update(dict(exp=expire))  # type: ignore[dict-item]
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
+
+
+# 已验证 token 的摘要 -> claims
+token_cache: LRUCache[bytes, dict] = LRUCache(TOKEN_CACHE_SIZE)
+# 已吊销 token 的摘要 -> 过期时间戳，过期后自动清理
+revoked_tokens: dict[bytes, float] = {}
+
+
+def _digest(token: str) -> bytes:
+    return hashlib.sha256(token.encode()).digest()
+
+
+def decode_token(token: str) -> dict:
+    """
+    校验并解析token，已验证过的token直接从缓存返回，跳过签名校验
+    :param token: token
+    :return: claims
+    """
+    digest = _digest(token)
+    if digest in revoked_tokens:
+        raise JWTError("Token has been revoked.")
+    claims = token_cache.get(digest)
+    if claims is None:
+        claims = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        token_cache.set(digest, claims)
+    elif claims.get("exp", 0) <= time.time():
+        token_cache.pop(digest)
+        raise ExpiredSignatureError("Signature has expired.")
+    return claims
+
+
+def revoke_token(token: str) -> tuple[bytes, float] | None:
+    """
+    吊销token，同时从缓存中移除，只吊销签名校验通过的token
+    :param token: token
+    :return: (摘要, 过期时间戳)，校验失败、已过期或已吊销时返回 None
+    """
+    try:
+        exp = decode_token(token).get("exp", 0)
+    except JWTError:
+        return None
+    digest = _digest(token)
+    if revoke_digest(digest, exp):
+        return digest, exp
+    return None
+
+
+def revoke_digest(digest: bytes, exp: float) -> bool:
+    """
+    按摘要吊销token，用于同步其他进程的吊销记录
+    :param digest: token 摘要
+    :param exp: 过期时间戳，已过期的不再记录
+    :return: 是否记录
+    """
+    now = time.time()
+    for key in [key for key, value in revoked_tokens.items() if value <= now]:
+        del revoked_tokens[key]
+    token_cache.pop(digest)
+    if exp > now:
+        revoked_tokens[digest] = exp
+        return True
+    return False
@@ -9,7 +9,85 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7
 
 # ORN
 DB_URL = "sqlite://db.sqlite3"
+# 启动时是否创建常用查询索引，以及索引列表 (表名, 字段列表)
+SCHEMA_CREATE_INDEXES = True
+SCHEMA_INDEXES = [
+    ("menu", ["parent_id"]),
+    ("user", ["active_role_id"]),
+    ("casbin_rule", ["ptype", "v0", "v1"]),
+]
+# 启动时为已有的表补充后来新增的字段 (表名, 字段名, 字段定义)，新建的表已包含这些字段
+SCHEMA_COLUMNS = [
+    ("user", "token_version", "INT NOT NULL DEFAULT 0"),
+    ("menu", "tree_path", "VARCHAR(255) NOT NULL DEFAULT '/'"),
+    ("menu", "depth", "INT NOT NULL DEFAULT 0"),
+]
 
 BASE_DIR = os.path.dirname(os.path.dirname(__file__))
+# 自动发现路由、模型的应用包，为空时扫描整个项目
+APP_PACKAGES = ["apps"]
+# 模块发现结果缓存文件，为空时不缓存
+DISCOVERY_MANIFEST = os.path.join(BASE_DIR, ".discovery.json")
 # 上传文件保留路径
 DISK_PATH = os.path.join(BASE_DIR, "disk")
+# 上传文件大小上限、分块读写大小（字节）
+UPLOAD_MAX_SIZE = 1024 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# 分片上传会话有效期、过期会话清理间隔（秒）
+UPLOAD_SESSION_TTL = 60 * 60 * 24
+UPLOAD_CLEANUP_INTERVAL = 60 * 60
+# 下载文件（/disk）是否需要登录并校验接口权限
+DISK_REQUIRE_PERMISSION = False
+
+# 用户身份缓存（jwt_auth/check_permission），ttl 单位秒
+PRINCIPAL_CACHE_SIZE = 10000
+PRINCIPAL_CACHE_TTL = 60
+
+# 授权结果缓存容量（角色、路由模板、请求方法）
+DECISION_CACHE_SIZE = 100000
+
+# 权限判定模式：compiled 使用编译后的策略索引，casbin 使用 casbin 逐条匹配
+ENFORCER_MODE = "compiled"
+
+# 多进程策略、token 吊销同步：轮询变更日志的间隔（秒）、
+# 变更日志保留天数（不能短于 token 有效期，否则新进程启动时会丢失吊销记录）
+POLICY_SYNC_INTERVAL = 1
+POLICY_SYNC_RETENTION_DAYS = 7
+# 变更日志ID空洞（事务未提交或已回滚）的等待时间（秒），需大于最长的写事务
+POLICY_SYNC_GAP_TIMEOUT = 60
+# 轮询时清理过期变更日志的间隔（秒）
+POLICY_SYNC_PRUNE_INTERVAL = 60 * 60
+
+# 密码哈希：bcrypt 成本因子（修改后用户登录时自动重新哈希）、
+# 执行器类型 thread/process、并发上限、排队上限（超出直接返回 503）
+BCRYPT_ROUNDS = 12
+PASSWORD_HASH_EXECUTOR = "thread"
+PASSWORD_HASH_WORKERS = 4
+PASSWORD_HASH_QUEUE_SIZE = 64
+# 批量导入用户时计算密码哈希的进程数、每批写入的用户数
+BULK_HASH_WORKERS = os.cpu_count() or 4
+USER_IMPORT_BATCH_SIZE = 1000
+# 流式导出时每批查询的行数
+EXPORT_BATCH_SIZE = 1000
+# 批量更新、删除接口单次最多处理的ID数
+BATCH_MAX_IDS = 5000
+
+# 已验证 token 缓存容量
+TOKEN_CACHE_SIZE = 10000
+
+# 无状态认证：access token 中携带用户标识与当前角色，鉴权无需查询数据库；
+# access token 有效期较短，过期后通过刷新 token 换取（刷新时校验用户 token 版本）
+AUTH_STATELESS = False
+STATELESS_ACCESS_TOKEN_EXPIRE_MINUTES = 15
+REFRESH_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7
+
+# 登录时间批量写入间隔（秒）
+LAST_LOGIN_FLUSH_INTERVAL = 5
+
+# 分页总数缓存（count=cached 时使用），ttl 单位秒
+COUNT_CACHE_SIZE = 1024
+COUNT_CACHE_TTL = 30
+
+# 菜单树缓存：缓存的角色数量上限、轮询其他进程菜单变更的间隔（秒）
+MENU_CACHE_SIZE = 1024
+MENU_CACHE_SYNC_INTERVAL = 1